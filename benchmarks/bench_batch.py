@@ -0,0 +1,45 @@
+# coding=utf-8
+""" Transforming the math environments one by one versus in one batch (the "batch" setting), for
+documents made of many small inline environments. Run from the repository root:
+
+    python benchmarks/bench_batch.py
+"""
+from __future__ import unicode_literals, print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pretex.Transformer import Transformer, Config, get_math_segments, transform_math_batch
+
+
+def get_document(env_count, changed_share):
+    """ env_count inline environments, the given share of them with something to transform """
+    changed = [r"$a_ij <= b_j$", r"$x -> y$", r"$\frac a+b 2$", r"$\alpha*\beta$", r"$|\psi>$"]
+    unchanged = [r"$x$", r"$\alpha$", r"$n+1$", r"$f(x)$", r"$k_i$"]
+    envs = []
+    for i in range(env_count):
+        pool = changed if (i * changed_share) % 1 + changed_share >= 1 else unchanged
+        envs.append(pool[i % len(pool)])
+    return " text ".join(envs)
+
+
+def main():
+    print("{:>8} {:>8} {:>10} {:>10} {:>8}".format("envs", "changed", "single", "batch", "speedup"))
+    for env_count in [1000, 10000, 50000]:
+        for changed_share in [0.0, 0.1, 0.5]:
+            document = get_document(env_count, changed_share)
+            _, maths = get_math_segments(document)
+            durations = []
+            for batch in ["disabled", "enabled"]:
+                config = Config(batch=batch)
+                durations.append(min(timeit.repeat(lambda: transform_math_batch((config, maths, False, False)),
+                                                   number=1, repeat=3)))
+            assert Transformer(Config(batch="disabled")).get_transformed_str(document) == \
+                Transformer().get_transformed_str(document)
+            print("{:>8} {:>8.0%} {:>10.1f} {:>10.1f} {:>8.2f}".format(
+                env_count, changed_share, durations[0] * 1000, durations[1] * 1000, durations[0] / durations[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# coding=utf-8
+""" Brace heavy math with the code in the working tree against an older revision from git, by
+default the first commit. Each version runs in its own process. Run from the repository root:
+
+    python benchmarks/bench_braces.py [<revision>]
+"""
+from __future__ import unicode_literals, print_function
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+timing_code = """
+import io, sys, timeit
+sys.path.insert(0, sys.argv[1])
+from pretex.Transformer import Transformer
+with io.open(sys.argv[2], encoding="utf-8") as f:
+    document = f.read()
+transformer = Transformer()
+print(min(timeit.repeat(lambda: transformer.get_transformed_str(document), number=1, repeat=5)))
+"""
+
+
+def get_documents():
+    display = "\n".join(
+        "\\begin{{equation}}\n\\sum_{{i=1}}^{{n}} \\frac{{\\partial f}}{{\\partial x_{{i}}}} = "
+        "\\int_{{0}}^{{{0}}} g_{{k}}(t)\\, dt + \\mathbf{{v}}_{{j}}^{{2}} - \\sqrt{{a_{{{0}}} + b^{{2}}}}\n"
+        "\\end{{equation}}".format(i) for i in range(300))
+    inline = " text ".join("$x_{{n+{}}}$".format(i) for i in range(3000))
+    nested = "$" + "{a " * 16000 + "a*b" + "}" * 16000 + "$"
+    return [("display", display), ("inline", inline), ("nested", nested)]
+
+
+def export_revision(revision, directory):
+    """ Writes the pretex package of the revision into directory """
+    archive = subprocess.check_output(["git", "archive", "--format=tar", revision, "pretex"], cwd=root)
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(directory)
+
+
+def get_duration(package_root, document_filename):
+    output = subprocess.check_output([sys.executable, "-c", timing_code, package_root, document_filename])
+    return float(output.decode("utf-8").strip().splitlines()[-1])
+
+
+def main():
+    revision = sys.argv[1] if len(sys.argv) > 1 else \
+        subprocess.check_output(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=root).decode("utf-8").split()[0]
+    directory = tempfile.mkdtemp()
+    try:
+        export_revision(revision, directory)
+        print("{:>10} {:>12} {:>12} {:>8}".format("math", revision[:10], "working tree", "ratio"))
+        for name, document in get_documents():
+            document_filename = os.path.join(directory, name + ".tex")
+            with io.open(document_filename, 'w', encoding='utf-8') as file_out:
+                file_out.write(document)
+            old_duration = get_duration(directory, document_filename)
+            new_duration = get_duration(root, document_filename)
+            print("{:>10} {:>12.3f} {:>12.3f} {:>8.2f}".format(name, old_duration, new_duration,
+                                                              new_duration / old_duration))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
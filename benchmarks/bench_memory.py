@@ -0,0 +1,43 @@
+# coding=utf-8
+""" Memory used by each stage of Transformer.get_transformed_tree and by joining the output, in
+bytes per byte of input, for documents of growing size made by repeating the body of an arxiv
+paper. Measured with tracemalloc, needs python 3.9. Run from the repository root:
+
+    python benchmarks/bench_memory.py [<tex_file>]
+"""
+from __future__ import unicode_literals, print_function
+import io
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pretex.Transformer import Transformer, get_document_contents
+from pretex.stats import get_memory_stats
+
+stages = ["document", "strip_comments", "hide", "segment", "math", "tree", "restore", "join", "total"]
+
+
+def get_document(file_str, size):
+    """ file_str with its document body repeated until it has about size characters """
+    before_document, document_content, after_document = get_document_contents(file_str)
+    repeats = max(1, (size - len(before_document) - len(after_document)) // max(len(document_content), 1))
+    return before_document + document_content * repeats + after_document
+
+
+def main():
+    filename = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), "..", "tests",
+                                                                  "arxiv_quant-ph.tex")
+    with io.open(filename, encoding="utf-8") as f:
+        file_str = f.read()
+    transformer = Transformer()
+    print("{:>10} {:>8} ".format("size [kB]", "") + " ".join("{:>14}".format(stage) for stage in stages))
+    for size in [10 ** 5, 10 ** 6, 5 * 10 ** 6]:
+        document = get_document(file_str, size)
+        memory = get_memory_stats(transformer, document)
+        for key in ["peak", "allocated"]:
+            print("{:>10.0f} {:>8} ".format(len(document.encode("utf-8")) / 1000.0, key) +
+                  " ".join("{:>14.2f}".format(memory.get(stage, {}).get(key, 0.0)) for stage in stages))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# coding=utf-8
+""" How the cost of transforming a document grows with the number of user rules.
+
+"fusable" rules get compiled into the existing literal passes, "separate" ones overlap each other
+and need one pass each, like every rule did before. Every math environment of the document has a
+match of one of the user rules, so they all replace something. Rules whose triggers aren't in the
+math are skipped, which hides how many passes there are, so each case also runs with that skipping
+turned off. Both run with batch=disabled, the batch only transforms environments with triggers.
+Run from the repository root:
+
+    python benchmarks/bench_rules.py
+"""
+from __future__ import unicode_literals, print_function
+import io
+import json
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pretex import trafos
+from pretex.Transformer import Transformer, Config, get_default_config
+from pretex.trafos import get_prepared_rules
+
+
+def get_user_pattern(kind, index):
+    return "\\hs{}@".format(index) if kind == "fusable" else "@hs{}@".format(index)
+
+
+def get_document(env_count, kind, rule_count):
+    """ env_count environments, the i-th one with a match of user rule i % rule_count. Without rules
+    they have the pattern of rule 0 anyway, so all documents have the same size """
+    envs = [r"a_i <= b_j", r"x -> y", r"\frac a+b 2", r"\alpha*\beta", r"|\psi>", r"x"]
+    return " text ".join("${} + {}$".format(envs[i % len(envs)], get_user_pattern(kind, i % max(rule_count, 1)))
+                         for i in range(env_count))
+
+
+def write_rules_file(directory, kind, rule_count):
+    rules = [{"name": "r{}".format(i), "pattern": get_user_pattern(kind, i), "replacement": "\\mathrm{{h{}}}".format(i)}
+             for i in range(rule_count)]
+    filename = os.path.join(directory, "{}_{}.json".format(kind, rule_count))
+    with io.open(filename, 'w', encoding='utf-8') as file_out:
+        file_out.write(json.dumps({"rules": rules}, ensure_ascii=False))
+    return filename
+
+
+def no_skipped_passes(math_string, rule_passes, trigger_index, skips=None):
+    return frozenset()
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    get_skipped_passes = trafos.get_skipped_passes
+    print("{:>10} {:>6} {:>7} {:>9} {:>9} {:>10} {:>9}".format(
+        "rules", "extra", "passes", "replaced", "triggers", "time [ms]", "relative"))
+    for kind in ["fusable", "separate"]:
+        for skipping in [True, False]:
+            baseline = None
+            for rule_count in [0, 12, 48]:
+                document = get_document(10000, kind, rule_count)
+                trans = Transformer(Config(get_default_config(write_rules_file(directory, kind, rule_count)),
+                                           batch="disabled"))
+                pass_count = len(get_prepared_rules(trans.config)[0])
+                trafos.get_skipped_passes = get_skipped_passes if skipping else no_skipped_passes
+                try:
+                    output = trans.get_transformed_str(document)
+                    duration = min(timeit.repeat(lambda: trans.get_transformed_str(document), number=1, repeat=5))
+                finally:
+                    trafos.get_skipped_passes = get_skipped_passes
+                baseline = baseline or duration
+                print("{:>10} {:>6} {:>7} {:>9} {:>9} {:>10.1f} {:>9.2f}".format(
+                    kind, rule_count, pass_count, output.count("\\mathrm{h"), "on" if skipping else "off",
+                    duration * 1000, duration / baseline))
+
+
+if __name__ == "__main__":
+    main()
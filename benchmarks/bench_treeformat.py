@@ -0,0 +1,47 @@
+# coding=utf-8
+""" Size and speed of the binary doc tree format of pretex.treeformat compared to pickle and json,
+for the doc trees of documents with many math environments. Run from the repository root:
+
+    python benchmarks/bench_treeformat.py
+"""
+from __future__ import unicode_literals, print_function
+import json
+import os
+import pickle
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from pretex.Transformer import Transformer
+from pretex.treeformat import encode_tree, decode_tree
+
+
+def get_document(env_count):
+    envs = [r"$a_ij <= b_j$", r"$x -> y$", r"$\frac a+b 2$", r"$\alpha*\beta$", r"$|\psi>$", r"$x$", r"$f(x)$"]
+    return " some text ".join(envs[i % len(envs)] for i in range(env_count))
+
+
+def get_formats():
+    return [
+        ("pickle", lambda tree: pickle.dumps(tree, pickle.HIGHEST_PROTOCOL), pickle.loads),
+        ("json", lambda tree: json.dumps(tree).encode("utf-8"), lambda data: json.loads(data.decode("utf-8"))),
+        ("treeformat", encode_tree, decode_tree),
+        ("treeformat mv", encode_tree, lambda data: decode_tree(memoryview(data))),
+    ]
+
+
+def main():
+    print("{:>8} {:>14} {:>10} {:>12} {:>12}".format("envs", "format", "size [kB]", "encode [ms]", "decode [ms]"))
+    for env_count in [1000, 10000, 100000]:
+        doc_tree = Transformer().get_transformed_tree(get_document(env_count))
+        for name, encode, decode in get_formats():
+            data = encode(doc_tree)
+            assert decode(data) == doc_tree
+            encode_time = min(timeit.repeat(lambda: encode(doc_tree), number=1, repeat=5))
+            decode_time = min(timeit.repeat(lambda: decode(data), number=1, repeat=5))
+            print("{:>8} {:>14} {:>10.1f} {:>12.1f} {:>12.1f}".format(
+                env_count, name, len(data) / 1000.0, encode_time * 1000, decode_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,19 @@
 # coding=utf-8
 from __future__ import unicode_literals
+import bisect
 import copy
 import io
 import json
+import multiprocessing
 import re
 import textwrap
 import pkg_resources
 from functools import partial
-from .trafos import transform_auto_align, transform_main
+from .trafos import transform_auto_align, transform_main, transform_main_batch, get_user_rule_defaults, \
+    get_prepared_rules, get_trigger_pattern
+from .stats import timed, add_math_stats
+from .sourcemap import SourceMap, get_edits_map, compose_maps, compose_all, shift_map, normalize_anchors, lookup, \
+    get_line_starts
 
 
 def get_inside_str(s):
@@ -28,13 +34,29 @@ def get_document_contents(file_str):
     return before_document, document_content, after_document
 
 
-def strip_comments(ss):
+def strip_comments(ss, maps=None):
     def strip_line_comment(line):
         return re.split(r"(?<!\\)%", line)[0]
-    return "\n".join(map(strip_line_comment, ss.split("\n")))
-
-
-def hide_math_stuff(document_str):
+    lines = ss.split("\n")
+    stripped_lines = list(map(strip_line_comment, lines))
+    if maps is not None:
+        edits = []
+        in_pos = out_pos = 0
+        for line, stripped_line in zip(lines, stripped_lines):
+            if len(stripped_line) < len(line):
+                out_pos_end = out_pos + len(stripped_line)
+                edits.append((in_pos + len(stripped_line), in_pos + len(line), out_pos_end, out_pos_end))
+            in_pos += len(line) + 1
+            out_pos += len(stripped_line) + 1
+        maps.append(get_edits_map(edits, len(ss), out_pos - 1))
+    return "\n".join(stripped_lines)
+
+
+# what hide_math_stuff leaves in place of the hidden stuff
+re_hidden = re.compile(r"%[ce] ")
+
+
+def hide_math_stuff(document_str, maps=None):
     pattern = re.compile(r"""
           \\(?:text|label|mbox|textrm)
           \ *?
@@ -42,111 +64,358 @@ def hide_math_stuff(document_str):
         """, re.VERBOSE)
 
     stuff_saved = []
+    edits = []
     def repl(match_obj):
+        out_start = match_obj.start() - (edits[-1][1] - edits[-1][3] if edits else 0)
+        edits.append((match_obj.start(), match_obj.end(), out_start, out_start + 3))
         stuff_saved.append(match_obj.group(0))
         return "%e "
     return_str = pattern.sub(repl, document_str)
+    if maps is not None:
+        maps.append(get_edits_map(edits, len(document_str), len(return_str)))
     return return_str, stuff_saved
 
 
-def get_default_config():
+def get_default_config(rules_file=""):
     config = {key: "enabled" for key in
               ["arrow", "approx", "leq", "sub_superscript", "geq", "ll",
                "gg", "neq", "cdot", "braket", "dots", "frac", "auto_align", "substack"]}
     config.update({key: "disabled" for key in ["dot", "brackets", "html"]})
     config["braket_style"] = "small"
+    config["rules_file"] = rules_file
+    config["jobs"] = "1"
+    config["batch"] = "enabled"
+    for name, default in get_user_rule_defaults(rules_file).items():
+        if name in config:
+            raise ValueError("Rule name '{}' is already a setting".format(name))
+        config[name] = default
     return config
 
 
-def get_transformed_math(content, config, env_type=None ):
-        """ the actual transformations with the math contents """
+class Config(dict):
+    """ Immutable settings. Only the keys of get_default_config (with its rules file) are allowed,
+    missing ones get their defaults. The hash is computed once, so a Config is a cheap cache key.
+    Use replace() to get a changed copy """
+    __slots__ = ("_hash",)
+
+    def __init__(self, *args, **kwargs):
+        settings = dict(*args, **kwargs)
+        config = get_default_config(settings.get("rules_file", ""))
+        for setting, value in settings.items():
+            if setting not in config:
+                raise ValueError("Unknown setting '{}'".format(setting))
+            config[setting] = value
+        super(Config, self).__init__(config)
+        self._hash = hash(frozenset(self.items()))
+
+    def __hash__(self):
+        return self._hash
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Config is immutable, use replace() to change settings")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = __ior__ = _immutable
+
+    def __reduce__(self):
+        return Config, (dict(self),)
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def replace(self, *args, **kwargs):
+        settings = dict(self)
+        settings.update(*args, **kwargs)
+        return Config(settings)
+
+
+def get_transformed_math(content, config, env_type=None, maps=None, skips=None):
+        """ the actual transformations with the math contents. If maps is a list, the source map of
+        the result to content is appended. skips is an optional dict counting the rules skipped by
+        their triggers """
 
         trafos = []
-        content, trafos_auto_align = transform_auto_align(content, config, env_type)
-        content, trafos_main = transform_main(content, config)
+        stage_maps = [] if maps is not None else None
+        content, trafos_auto_align = transform_auto_align(content, config, env_type, stage_maps)
+        content, trafos_main = transform_main(content, config, stage_maps, skips)
         trafos.extend(trafos_main)
         trafos.extend(trafos_auto_align)
+        if maps is not None:
+            maps.append(compose_all(stage_maps))
         return content, trafos
 
 
-class Transformer(object):
-    def __init__(self):
-        self.config = get_default_config()
-        
-
-    def get_pretextec_tree(self, document_str):
-        re_extract_math = re.compile(r"""
-            (?P<env_opening>
-              (?<!\\)(?P<dd>\$\$) |
-              (?<!\\)(?P<sd>\$) |
-              (?<!\\)(?P<braces>\\\() |
-              (?<!\\)(?P<braces_sq>\\\[) |
-              \\begin\ *?{
-                (?P<env_name>(?:
-                  equation|align|math|displaymath|eqnarray|gather|flalign|multiline|alignat
-                )\*?)}
-            )
-
-            (?P<content>
-              (?:\n|\\\$|[^\$])+?
-            )
-
-            (?P<env_closing>
-              (?(dd)\$\$|(?!)) |
-              (?(sd)\$|(?!)) |
-              (?(braces)\\\)|(?!)) |
-              (?(braces_sq)\\\]|(?!)) |
-              (?(env_name)\\end\ *?{(?P=env_name)}|(?!))
-            )
-            """, re.VERBOSE)
+re_extract_math = re.compile(r"""
+    (?P<env_opening>
+      (?<!\\)(?P<dd>\$\$) |
+      (?<!\\)(?P<sd>\$) |
+      (?<!\\)(?P<braces>\\\() |
+      (?<!\\)(?P<braces_sq>\\\[) |
+      \\begin\ *?{
+        (?P<env_name>(?:
+          equation|align|math|displaymath|eqnarray|gather|flalign|multiline|alignat
+        )\*?)}
+    )
+
+    (?P<content>
+      (?:\n|\\\$|[^\$])+?
+    )
+
+    (?P<env_closing>
+      (?(dd)\$\$|(?!)) |
+      (?(sd)\$|(?!)) |
+      (?(braces)\\\)|(?!)) |
+      (?(braces_sq)\\\]|(?!)) |
+      (?(env_name)\\end\ *?{(?P=env_name)}|(?!))
+    )
+    """, re.VERBOSE)
+
+
+def get_math_segments(document_str):
+    """ Splits the document into the texts between math contents (including the math delimiters)
+    and the (content, env_type) of each math part. There is one more text than math parts """
+    texts = []
+    maths = []
+    text_start = 0
+    for math_match in re_extract_math.finditer(document_str):
+        texts.append(document_str[text_start:math_match.start("content")])
+        maths.append((math_match.group("content"), math_match.group("env_name") or "inline"))
+        text_start = math_match.end("content")
+    texts.append(document_str[text_start:])
+    return texts, maths
+
+
+def get_restore_map(doc_tree, saved_stuff):
+    """ Source map of putting the hidden stuff back into the doc tree """
+    edits = []
+    shift = 0
+    for match, saved in zip(re_hidden.finditer("".join(el["content"] for el in doc_tree)), saved_stuff):
+        edits.append((match.start(), match.end(), match.start() + shift, match.start() + shift + len(saved)))
+        shift += len(saved) - 3
+    in_length = sum(len(el["content"]) for el in doc_tree)
+    return get_edits_map(edits, in_length, in_length + shift)
+
+
+def transform_math_batched(config, maths, with_skips=False):
+    """ Like get_transformed_math for each of the (content, env_type), but the main rules run over
+    all of them at once, see transform_main_batch """
+    aligned = [transform_auto_align(content, config, env_type) for content, env_type in maths]
+    skips = [{} for _ in maths] if with_skips else None
+    results = transform_main_batch([content for content, _ in aligned], config, skips)
+    return [(content, trafos_main + trafos_auto_align, None, skips[i] if with_skips else None)
+            for i, ((content, trafos_main), (_, trafos_auto_align)) in enumerate(zip(results, aligned))]
+
+
+def transform_math_batch(batch):
+    """ Process pool entry point: transforms a list of (content, env_type) with the config. Returns
+    (content, trafos, source map or None, skip counts or None) for each """
+    config, maths, with_maps, with_skips = batch
+    if not with_maps and config["batch"] != "disabled":
+        return transform_math_batched(config, maths, with_skips)
+    results = []
+    for content, env_type in maths:
+        maps = [] if with_maps else None
+        skips = {} if with_skips else None
+        content, trafos = get_transformed_math(content, config, env_type, maps, skips)
+        results.append((content, trafos, maps[0] if with_maps else None, skips))
+    return results
 
+
+class Transformer(object):
+    """ Transforms documents with its config. The config is immutable and nothing else is changed
+    by the transformations, so one Transformer can be shared by threads """
+    # math contents smaller than this in total are transformed serially even with jobs > 1, because
+    # starting the processes and sending the data around would take longer
+    parallel_min_size = 200000
+
+    def __init__(self, config=None):
+        self.config = config if config is not None else get_default_config()
+
+
+    @property
+    def config(self):
+        return self._config
+
+
+    @config.setter
+    def config(self, config):
+        self._config = config if isinstance(config, Config) else Config(config)
+
+
+    def get_transformed_maths(self, maths, with_maps=False, with_skips=False):
+        """ Transforms the (content, env_type) list, with a process pool if config["jobs"] > 1 """
+        jobs = int(self.config["jobs"])
+        if jobs <= 1 or len(maths) < 2 or sum(len(content) for content, _ in maths) < self.parallel_min_size:
+            return transform_math_batch((self.config, maths, with_maps, with_skips))
+
+        batch_size = -(-len(maths) // (jobs * 4))  # a few batches per process to even out the load
+        batches = [(self.config, maths[i:i+batch_size], with_maps, with_skips)
+                   for i in range(0, len(maths), batch_size)]
+        pool = multiprocessing.Pool(jobs)
+        try:
+            batch_results = pool.map(transform_math_batch, batches)
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return [result for batch_result in batch_results for result in batch_result]
+
+
+    def get_pretextec_tree(self, document_str, maps=None, stats=None):
+        with timed(stats, "segment"):
+            texts, maths = get_math_segments(document_str)
         doc_tree = []
-        math_match = re_extract_math.search(document_str)
-        while math_match:  # Can't use finditer() because document_str is changed during iteration
-            # text part
-            before_document = document_str[:math_match.start()] + math_match.group("env_opening")
-            doc_tree.append({"type": "text", "content": before_document})
-
-            # math part
-            env_type = math_match.group("env_name") or "inline"
-            math_content, trafos = get_transformed_math(math_match.group("content"), self.config, env_type)
-            doc_tree.append({"type": "math_env",
-                             "content": math_content, "pretexes": trafos})
-
-            # iteration
-            document_str = math_match.group("env_closing") + document_str[math_match.end():]
-            math_match = re_extract_math.search(document_str, len(math_match.group("env_closing")))
-
-        doc_tree.append({"type": "text", "content": document_str})
+        anchors = []
+        out_pos = in_pos = 0
+        with timed(stats, "math"):
+            transformed_maths = self.get_transformed_maths(maths, with_maps=maps is not None,
+                                                           with_skips=stats is not None)
+        with timed(stats, "tree"):
+            for text, (content, env_type), (math_content, trafos, math_map, skips) in zip(texts, maths, transformed_maths):
+                doc_tree.append({"type": "text", "content": text})
+                doc_tree.append({"type": "math_env", "content": math_content, "pretexes": trafos})
+                if stats is not None:
+                    add_math_stats(stats, env_type, math_content, trafos, skips)
+                if maps is not None:
+                    out_pos += len(text)
+                    in_pos += len(text)
+                    anchors.extend(zip(*shift_map(math_map, out_pos, in_pos)))
+                    out_pos += len(math_content)
+                    in_pos += len(content)
+            doc_tree.append({"type": "text", "content": texts[-1]})
+        if maps is not None:
+            anchors.extend([(0, 0), (out_pos + len(texts[-1]), in_pos + len(texts[-1]))])
+            maps.append(normalize_anchors(anchors))
         return doc_tree
 
 
-    def get_transformed_tree(self, content, filename="unknown"):
-        before_document, document_content, after_document = get_document_contents(content)
-        document_content = strip_comments(document_content)
-        document_content, saved_stuff = hide_math_stuff(document_content)
-        doc_tree = self.get_pretextec_tree(document_content)
+    def get_transformed_tree(self, content, filename="unknown", maps=None, stats=None):
+        """ If maps is a list, the source map of the output to content is appended. stats from
+        stats.get_empty_stats get the statistics of this run added """
+        stage_maps = [] if maps is not None else None
+        with timed(stats, "document"):
+            before_document, document_content, after_document = get_document_contents(content)
+        with timed(stats, "strip_comments"):
+            document_content = strip_comments(document_content, stage_maps)
+        with timed(stats, "hide"):
+            document_content, saved_stuff = hide_math_stuff(document_content, stage_maps)
+        doc_tree = self.get_pretextec_tree(document_content, stage_maps, stats)
 
         # Add the rest from document and insert header/footer at the edges
         doc_tree[0]["content"] = before_document + doc_tree[0]["content"]
         doc_tree[-1]["content"] = doc_tree[-1]["content"] + after_document
 
+        if maps is not None:
+            out_length = sum(len(el["content"]) for el in doc_tree)
+            document_map = shift_map(compose_all(stage_maps), len(before_document), len(before_document))
+            maps.append(normalize_anchors([(0, 0), (out_length, len(content))] + list(zip(*document_map))))
+            if saved_stuff:
+                maps[-1] = compose_maps(get_restore_map(doc_tree, saved_stuff), maps[-1])
+
         if saved_stuff:
-            for el in doc_tree:
-                el["content"] = re.compile(r"%[ce] ").sub(lambda x: saved_stuff.pop(0), el["content"])
+            with timed(stats, "restore"):
+                for el in doc_tree:
+                    el["content"] = re_hidden.sub(lambda x: saved_stuff.pop(0), el["content"])
 
         if self.config["html"] == "enabled":
-            self.viz_output(doc_tree, filename)
+            with timed(stats, "html"):
+                self.viz_output(doc_tree, filename)
 
+        if stats is not None:
+            stats["files"] += 1
+            stats["chars_in"] += len(content)
+            stats["chars_out"] += sum(len(el["content"]) for el in doc_tree)
         return doc_tree
 
 
+    def get_changed_math_edits(self, content, line_ranges):
+        """ Transforms only the math environments of content that overlap one of the sorted
+        (first, last) line ranges, like from gitdiff.get_changed_lines. Returns an edit
+        {"start", "end", "line", "content", "pretexes"} for each one that changed: content[start:end]
+        becomes the new content, as in the output file. Only the segmentation looks at the whole
+        document, the math delimiters depend on everything before them """
+        before_document, document_content, _ = get_document_contents(content)
+        stage_maps = []
+        document_content = strip_comments(document_content, stage_maps)
+        document_content, saved_stuff = hide_math_stuff(document_content, stage_maps)
+        out_offsets, in_offsets = shift_map(compose_all(stage_maps), 0, len(before_document))
+        hidden_starts = [match.start() for match in re_hidden.finditer(document_content)]
+        line_starts = get_line_starts(content)
+        range_ends = [last for _, last in line_ranges]
+        texts, maths = get_math_segments(document_content)
+
+        selected = []
+        pos = 0
+        for text, math in zip(texts, maths):
+            pos += len(text)
+            start = lookup(out_offsets, in_offsets, pos)
+            end = lookup(out_offsets, in_offsets, pos + len(math[0]))
+            first_line = bisect.bisect_right(line_starts, start)
+            range_index = bisect.bisect_left(range_ends, first_line)
+            if range_index < len(line_ranges) and line_ranges[range_index][0] <= bisect.bisect_right(line_starts, end):
+                selected.append((start, end, first_line, bisect.bisect_left(hidden_starts, pos), math))
+            pos += len(math[0])
+
+        edits = []
+        transformed_maths = self.get_transformed_maths([math for _, _, _, _, math in selected])
+        for (start, end, line, hidden_index, _), (math_content, trafos, _, _) in zip(selected, transformed_maths):
+            if trafos:
+                saved = iter(saved_stuff[hidden_index:])
+                math_content = re_hidden.sub(lambda _: next(saved), math_content)
+                edits.append({"start": start, "end": end, "line": line, "content": math_content, "pretexes": trafos})
+        return edits
+
+
+    def get_first_change(self, content):
+        """ The first place in content where a rule would change something, as
+        {"start", "line", "column", "type"} with the offset, 1-based line and column and the rule
+        name, or None if the document stays as it is. The math environments are searched for the
+        triggers of the rules while they are found, and only the ones with a trigger and the align
+        environments for auto_align are transformed, until one changes """
+        before_document, document_content, _ = get_document_contents(content)
+        stage_maps = []
+        document_content = strip_comments(document_content, stage_maps)
+        document_content, _ = hide_math_stuff(document_content, stage_maps)
+        _, _, trigger_index = get_prepared_rules(self.config)
+        trigger_pattern = get_trigger_pattern(trigger_index) if not trigger_index[1] else None
+        align_types = ["align", "align*"] if self.config["auto_align"] != "disabled" else []
+
+        for math_match in re_extract_math.finditer(document_content):
+            math_content, env_type = math_match.group("content"), math_match.group("env_name") or "inline"
+            if env_type in align_types or trigger_pattern is None or trigger_pattern.search(math_content):
+                if get_transformed_math(math_content, self.config, env_type)[1]:
+                    break
+        else:
+            return None
+
+        math_maps = []
+        _, trafos = get_transformed_math(math_content, self.config, env_type, math_maps)
+        first = min(trafos, key=lambda trafo: lookup(math_maps[0][0], math_maps[0][1], trafo["start"]))
+        pos = math_match.start("content") + lookup(math_maps[0][0], math_maps[0][1], first["start"])
+        out_offsets, in_offsets = shift_map(compose_all(stage_maps), 0, len(before_document))
+        start = lookup(out_offsets, in_offsets, pos)
+        line_starts = get_line_starts(content)
+        line = bisect.bisect_right(line_starts, start)
+        return {"start": start, "line": line, "column": start - line_starts[line - 1] + 1, "type": first["type"]}
+
+
     def get_transformed_str(self, content, filename="unknown"):
         doc_tree = self.get_transformed_tree(content, filename)
         document_content_new = "".join([element["content"] for element in doc_tree])
         return document_content_new
 
 
+    def get_source_map(self, content, filename="unknown"):
+        """ Transforms content and returns the SourceMap of the output back to it """
+        maps = []
+        doc_tree = self.get_transformed_tree(content, filename, maps)
+        return SourceMap(maps[0], content, "".join([element["content"] for element in doc_tree]))
+
+
     @staticmethod
     def viz_output(tree, filename="unknown"):
         html_str = ""
@@ -0,0 +1,115 @@
+# coding=utf-8
+""" Which lines of which files a unified diff changed, for transforming only the math around them """
+from __future__ import unicode_literals
+import re
+import subprocess
+
+re_new_file = re.compile(r"^\+\+\+ (?P<filename>[^\t\n]*)")
+re_quoted_char = re.compile(r"\\([0-7]{1,3}|.)")
+c_escapes = {"a": "\a", "b": "\b", "t": "\t", "n": "\n", "v": "\v", "f": "\f", "r": "\r", '"': '"', "\\": "\\"}
+re_hunk = re.compile(r"^@@ -\d+(?:,(?P<old_count>\d+))? \+(?P<start>\d+)(?:,(?P<count>\d+))? @@")
+
+
+def add_line_range(line_ranges, first, last):
+    if line_ranges and first <= line_ranges[-1][1] + 1:
+        line_ranges[-1] = (line_ranges[-1][0], max(last, line_ranges[-1][1]))
+    else:
+        line_ranges.append((first, last))
+
+
+def unquote_filename(filename):
+    """ git writes filenames with special chars in C-style quotes, non-ASCII chars as the octal
+    escapes of their UTF-8 bytes: "b/kapitel_\\303\\274.tex" """
+    if not filename.startswith('"'):
+        return filename
+    if len(filename) < 2 or not filename.endswith('"'):
+        raise ValueError("Can't read the quoted filename {} of the diff".format(filename))
+    quoted = filename[1:-1]
+    name_bytes = bytearray()
+    last_end = 0
+    for match in re_quoted_char.finditer(quoted):
+        name_bytes.extend(quoted[last_end:match.start()].encode("utf-8"))
+        escape = match.group(1)
+        if escape[0] in "01234567" and int(escape, 8) < 256:
+            name_bytes.append(int(escape, 8))
+        elif escape in c_escapes:
+            name_bytes.extend(c_escapes[escape].encode("utf-8"))
+        else:
+            raise ValueError("Can't read the quoted filename {} of the diff".format(filename))
+        last_end = match.end()
+    name_bytes.extend(quoted[last_end:].encode("utf-8"))
+    try:
+        return bytes(name_bytes).decode("utf-8")
+    except UnicodeDecodeError:
+        raise ValueError("Can't read the quoted filename {} of the diff".format(filename))
+
+
+def get_changed_lines(diff_str):
+    """ {filename: [(first, last)]} of the lines that were added or changed in the new version of
+    each file, 1-based, inclusive and sorted. Lines that were only removed give the two lines
+    around them. Quoted filenames are unquoted and a "b/" prefix is removed, deleted files are
+    left out. A hunk has
+    as many lines as its header says, so a removed "-- x" or added "++ x" line is no file header """
+    changed_lines = {}
+    line_ranges = None
+    new_line = 0
+    old_left = new_left = 0
+    removed = False
+    for line in diff_str.split("\n") + [""]:
+        if old_left or new_left:
+            if line[:1] == "+" and new_left:
+                add_line_range(line_ranges, new_line, new_line)
+                new_line += 1
+                new_left -= 1
+                removed = False
+                continue
+            if line[:1] == "-" and old_left:
+                old_left -= 1
+                removed = True
+                continue
+            if line[:1] == "\\":
+                continue
+        if removed:
+            add_line_range(line_ranges, max(new_line - 1, 1), new_line)
+            removed = False
+        if (old_left or new_left) and line[:1] in [" ", ""]:
+            # context lines, some tools strip the space of empty ones
+            new_line += 1
+            old_left = max(old_left - 1, 0)
+            new_left = max(new_left - 1, 0)
+            continue
+
+        old_left = new_left = 0
+        new_file_match = re_new_file.match(line)
+        hunk_match = re_hunk.match(line)
+        if new_file_match:
+            filename = unquote_filename(new_file_match.group("filename"))
+            if filename == "/dev/null":
+                line_ranges = None
+            else:
+                line_ranges = changed_lines.setdefault(filename[2:] if filename.startswith("b/") else filename, [])
+        elif hunk_match and line_ranges is not None:
+            # a hunk without new lines starts at the line before it
+            new_line = int(hunk_match.group("start")) + (hunk_match.group("count") == "0")
+            old_left = int(hunk_match.group("old_count") or 1)
+            new_left = int(hunk_match.group("count") or 1)
+    return {filename: line_ranges for filename, line_ranges in changed_lines.items() if line_ranges}
+
+
+def get_git_diff(ref="HEAD", paths=(), cwd=None):
+    """ `git diff` of the working tree against ref, with filenames relative to cwd """
+    command = ["git", "-c", "core.quotePath=false", "diff", "--relative", "--unified=0", "--no-color", "--no-ext-diff", ref, "--"] + list(paths)
+    try:
+        diff_bytes = subprocess.check_output(command, cwd=cwd)
+    except (OSError, subprocess.CalledProcessError) as error:
+        raise ValueError("Running '{}' failed: {}".format(" ".join(command), error))
+    return diff_bytes.decode("utf-8", "replace")
+
+
+def get_git_root(cwd=None):
+    """ The top directory of the git repository that cwd is in, None outside of one """
+    try:
+        root = subprocess.check_output(["git", "rev-parse", "--show-toplevel"], cwd=cwd, stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return root.decode("utf-8").strip()
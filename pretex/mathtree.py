@@ -0,0 +1,192 @@
+# coding=utf-8
+""" Brace structure of math contents.
+
+The transformation rules are regexes, which can't know about nested {} groups. So every non-empty
+group is parsed into its own node and hidden in its parent's text behind a placeholder char #:
+x^{a_{i}} becomes the node "x^{#}" with the child "{a_{#}}" which has the child "{i}". Each node's
+text still contains its own braces, so the rules see the same context at the group borders as in
+the full string. After all nodes are transformed, the placeholders are replaced with the
+transformed children again. """
+from __future__ import unicode_literals
+import bisect
+import re
+from .sourcemap import normalize_anchors
+
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+
+re_brace_token = re.compile(r"\\[\\{}]|[{}]")  # escaped \{ and \} are no braces, \\{ is one
+re_placeholder = re.compile("[\ue000-\uf8ff\U000f0000-\U000ffffd]")
+PLACEHOLDER_COUNT = 0x1900 + 0xfffe
+
+
+def get_placeholder(index):
+    """ Unicode private use chars, they don't occur in real documents and don't match \\w """
+    if index < 0x1900:
+        return unichr(0xe000 + index)
+    return unichr(0xf0000 + index - 0x1900)
+
+
+def get_brace_pairs(math_string):
+    """ (open, close) positions of all matching non-empty braces, sorted by the opening one. Braces
+    without partner are just text """
+    pairs = []
+    opened = []
+    for match in re_brace_token.finditer(math_string):
+        if match.group(0) == "{":
+            opened.append(match.start())
+        elif match.group(0) == "}" and opened:
+            open_pos = opened.pop()
+            if match.start() > open_pos + 1:  # {} stays as it is
+                pairs.append((open_pos, match.start() + 1))
+    pairs.sort()
+    return pairs
+
+
+def parse_math(math_string):
+    """ Splits the math string into a list of nodes, parents before their children. A node has
+    "text" with the non-empty child groups hidden as {placeholder}, "children" as (placeholder,
+    node index), "groups" mapping placeholders to the hidden child contents without the braces and
+    "span", its (start, end) in the math string. The first node is the whole string """
+    pairs = get_brace_pairs(math_string) if "{" in math_string else []
+    if not pairs or re_placeholder.search(math_string):
+        return [{"text": math_string, "children": [], "groups": {}, "span": (0, len(math_string))}]
+
+    spans = [(0, len(math_string))] + pairs
+    child_lists = [[] for _ in spans]
+    open_nodes = [0]
+    for node_index in range(1, len(spans)):
+        while spans[open_nodes[-1]][1] < spans[node_index][1]:
+            open_nodes.pop()
+        child_lists[open_nodes[-1]].append(node_index)
+        open_nodes.append(node_index)
+    if max(map(len, child_lists)) > PLACEHOLDER_COUNT:
+        return [{"text": math_string, "children": [], "groups": {}, "span": (0, len(math_string))}]
+
+    nodes = [None] * len(spans)
+    for node_index in range(len(spans) - 1, -1, -1):
+        start, end = spans[node_index]
+        pieces = []
+        children = []
+        groups = {}
+        for child_number, child_index in enumerate(child_lists[node_index]):
+            placeholder = get_placeholder(child_number)
+            child_start, child_end = spans[child_index]
+            pieces.append(math_string[start:child_start])
+            pieces.append("{" + placeholder + "}")
+            start = child_end
+            children.append((placeholder, child_index))
+            groups[placeholder] = nodes[child_index]["text"][1:-1]
+        pieces.append(math_string[start:end])
+        nodes[node_index] = {"text": "".join(pieces), "children": children, "groups": groups,
+                             "span": spans[node_index]}
+    return nodes
+
+
+def get_node_map(nodes, node_index):
+    """ Source map of the node text to the math string, each hidden group {#} is mapped to its
+    braces and content """
+    start, end = nodes[node_index]["span"]
+    out_offsets = [0]
+    in_offsets = [start]
+    shift = start
+    for _, child_index in nodes[node_index]["children"]:
+        child_start, child_end = nodes[child_index]["span"]
+        pos = child_start - shift
+        out_offsets.extend([pos, pos + 1, pos + 2, pos + 3])
+        in_offsets.extend([child_start, child_start + 1, child_end - 1, child_end])
+        shift += child_end - child_start - 3
+    out_offsets.append(end - shift)
+    in_offsets.append(end)
+    return out_offsets, in_offsets
+
+
+def join_math(nodes, results, node_maps=None):
+    """ Puts the transformed node texts back together. results are (text, trafos) for each node
+    with trafo positions relative to the node text. Returns the same for the whole string, or None
+    if a transformation broke the structure (lost a placeholder or the braces of its group).
+    node_maps are optional source maps of the node texts, node_maps[0] gets replaced with the one
+    of the joined string. The string is built once from the pieces of all nodes, so deep nesting
+    stays linear """
+    if len(nodes) == 1:
+        return results[0]
+
+    # positions of the placeholders in each result text, their children and the joined lengths
+    positions = [None] * len(nodes)
+    child_lists = [None] * len(nodes)
+    lengths = [0] * len(nodes)
+    for node_index in range(len(nodes) - 1, -1, -1):
+        text = results[node_index][0]
+        child_indices = dict(nodes[node_index]["children"])
+        positions[node_index] = node_positions = []
+        child_lists[node_index] = node_children = []
+        length = len(text)
+        for match in re_placeholder.finditer(text):
+            child_index = child_indices.pop(match.group(0), None)
+            if child_index is None:
+                return None
+            child_text = results[child_index][0]
+            if child_text[:1] != "{" or child_text[-1:] != "}":
+                return None
+            node_positions.append(match.start())
+            node_children.append(child_index)
+            length += lengths[child_index] - 3
+        if child_indices:
+            return None
+        lengths[node_index] = length
+
+    # offsets of the joined texts in the joined string, parents come before their children
+    offsets = [0] * len(nodes)
+    shifts = [None] * len(nodes)
+    for node_index in range(len(nodes)):
+        offset = offsets[node_index] - 1
+        shifts[node_index] = node_shifts = []
+        shift = 0
+        for pos, child_index in zip(positions[node_index], child_lists[node_index]):
+            offsets[child_index] = offset + pos + shift
+            shift += lengths[child_index] - 3
+            node_shifts.append(shift)
+
+    pieces = []
+    trafos = []
+    anchors = []
+    stack = [(0, None, None)]
+    while stack:
+        node_index, start, end = stack.pop()
+        text, node_trafos = results[node_index]
+        if start is not None:
+            pieces.append(text[start:end])
+            continue
+
+        if node_trafos or node_maps is not None:
+            node_positions = positions[node_index]
+            node_shifts = shifts[node_index]
+            offset = offsets[node_index]
+
+            def get_final_pos(pos):
+                i = bisect.bisect_left(node_positions, pos)
+                return pos + (node_shifts[i - 1] if i else 0) + offset
+
+            trafos.extend({"type": trafo["type"], "start": get_final_pos(trafo["start"]),
+                           "end": get_final_pos(trafo["end"])} for trafo in node_trafos)
+            if node_maps is not None:
+                node_anchors = ((get_final_pos(x), y) for x, y in zip(*node_maps[node_index]))
+                anchors.extend(node_anchors if node_index == 0 else
+                               ((x, y) for x, y in node_anchors if offset < x < offset + lengths[node_index]))
+
+        # the own text around the children, which are emitted in between, without the group braces
+        last_end = 0 if node_index == 0 else 1
+        items = []
+        for pos, child_index in zip(positions[node_index], child_lists[node_index]):
+            items.append((node_index, last_end, pos))
+            items.append((child_index, None, None))
+            last_end = pos + 1
+        items.append((node_index, last_end, len(text) if node_index == 0 else len(text) - 1))
+        stack.extend(reversed(items))
+
+    if node_maps is not None:
+        node_maps[0] = normalize_anchors(anchors)
+    return "".join(pieces), trafos
@@ -1,34 +1,73 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
-import copy
+import hashlib
+import json
+import os
 import sys
 import io
+import shutil
+import tempfile
 from docopt import docopt
-from .Transformer import Transformer
+from .Transformer import Transformer, Config, get_default_config
+from .sourcemap import translate_log
+from .stats import get_empty_stats, format_stats, check_stats_format
+from .gitdiff import get_changed_lines, get_git_diff, get_git_root
 from functools import partial
 
-def parse_cmd_arguments(config, parameters):
+def get_arguments(parameters):
     parse_string = """
 Usage:
-  pretex <file> [--set <key>=<val>...] [--html] [-o <output_file>]
+  pretex map <file> <log_file>... [--rules <rules_file>] [--set <key>=<val>...] [-o <output_file>]
+  pretex stats <tex_file>... [--rules <rules_file>] [--set <key>=<val>...] [-j <jobs>] [--format <format>]
+  pretex diff [<diff_file>] [--ref <ref>] [--rules <rules_file>] [--set <key>=<val>...]
+  pretex --check <tex_file>... [--rules <rules_file>] [--set <key>=<val>...]
+  pretex <file> [--rules <rules_file>] [--set <key>=<val>...] [--html] [-j <jobs>] [--stats <stats_file>] [-o <output_file>]
 
 Options:
   --set <key>=<val> set settings like braket, cdot
+  --rules <rules_file>  json file with additional rules
+  -j <jobs>     number of processes for the math of big documents
+  --stats <stats_file>  write statistics as json, or csv if the name ends with .csv
+  --format <format>  json or csv [default: json]
+  --ref <ref>   git revision to diff the working tree against [default: HEAD]
+  --check       only report the first place a rule would change in each file, exit with 1 if any
   -h --help     Show this screen.
   --version     Show version.
 
 Examples:
   pretex thesis.tex --set braket=disabled -o thesis_o.tex
+  pretex map thesis.tex thesis_t.log   # prints the log with the line numbers of thesis.tex
+  pretex stats chapters/*.tex --format csv   # prints statistics, writes nothing
+  pretex diff --ref origin/master   # prints the edits of the math in changed lines as json
+  git diff --cached | pretex diff -   # staged lines, but the math of the files as they are now
+  pretex --check chapters/*.tex   # prints file:line:column: rule, writes nothing
 """
     args = docopt(parse_string, argv=parameters, version='preTeX 1.0.0')
+    check_stats_format(args["--format"])  # before any file is transformed
+    return args
+
 
-    # parse config
-    config_new = copy.deepcopy(config)
+def get_config(config, args):
+    config_new = dict(config)
+    if args["--rules"]:
+        for setting, value in get_default_config(args["--rules"]).items():
+            config_new.setdefault(setting, value)
+        config_new["rules_file"] = args["--rules"]
     for setting, value in map(partial(str.split, sep="="), args["--set"]):
         if setting not in config_new:
             raise ValueError("Unknown setting '{}'".format(setting))
         config_new[setting] = value
     config_new["html"] = {True: "enabled", False: "disabled"}[args["--html"]]
+    if args["-j"]:
+        config_new["jobs"] = args["-j"]
+    if not config_new["jobs"].isdigit() or int(config_new["jobs"]) < 1:
+        raise ValueError("jobs has to be a positive number, not '{}'".format(config_new["jobs"]))
+    return Config(config_new)
+
+
+def parse_cmd_arguments(config, parameters):
+    args = get_arguments(parameters)
+    config_new = get_config(config, args)
 
     # output filename
     output_filename = args["<output_file>"]
@@ -41,15 +80,165 @@ Examples:
 
     return (args["<file>"]), output_filename, config_new
 
+def get_file_digest(filename, block_size=1 << 16):
+    """ sha1 of a file on disk, read in blocks. None if it doesn't exist """
+    digest = hashlib.sha1()
+    try:
+        with io.open(filename, 'rb') as file_in:
+            for block in iter(partial(file_in.read, block_size), b""):
+                digest.update(block)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+
+def write_if_changed(filename, chunks, encoding="utf-8"):
+    """ Writes the text chunks to filename unless the file already has exactly that content, so the
+    mtime only changes when the output does. The chunks are encoded one by one and only hashed at
+    first, so the whole output is never held as bytes. If the hash differs from the file's, they are
+    encoded again while writing to a temp file in the same directory, which then replaces the
+    target. chunks has to be a sequence for that. A symlink is written through. Returns True if the
+    file was written """
+    filename = os.path.realpath(filename)
+    digest = hashlib.sha1()
+    for encoded_chunk in encode_chunks(chunks, encoding):
+        digest.update(encoded_chunk)
+    if digest.hexdigest() == get_file_digest(filename):
+        return False
+
+    file_descriptor, temp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(filename), prefix=".pretex_", suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, 'wb') as file_out:
+            for encoded_chunk in encode_chunks(chunks, encoding):
+                file_out.write(encoded_chunk)
+        if os.path.exists(filename):
+            shutil.copymode(filename, temp_filename)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_filename, 0o666 & ~umask)
+        replace_file(temp_filename, filename)
+    except BaseException:
+        os.remove(temp_filename)
+        raise
+    return True
+
+
+def encode_chunks(chunks, encoding):
+    """ Yields the chunks encoded like a text mode file would, including newline translation """
+    for chunk in chunks:
+        if os.linesep != "\n":
+            chunk = chunk.replace("\n", os.linesep)  # pragma: no cover
+        yield chunk.encode(encoding)
+
+
+def replace_file(src, dst):
+    if hasattr(os, "replace"):
+        os.replace(src, dst)
+    else:  # pragma: no cover
+        # python 2 has no atomic replace on windows
+        if os.name == "nt" and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def print_mapped_logs(transformer, content, filename_in, filename_out, log_filenames):
+    """ Prints the LaTeX logs of the output file with the line numbers of the input file """
+    source_map = transformer.get_source_map(content, filename=filename_in)
+    for log_filename in log_filenames:
+        with io.open(log_filename, 'r', encoding='utf-8', errors='replace') as log_in:
+            log_str = log_in.read()
+        sys.stdout.write(translate_log(log_str, source_map, os.path.basename(filename_out),
+                                       os.path.basename(filename_in)))
+
+
+def get_files_stats(transformer, filenames):
+    """ The stats of transforming each file, by filename. Nothing is written """
+    stats_by_file = {}
+    for filename in filenames:
+        with io.open(filename, 'r', encoding='utf-8') as file_in:
+            content = file_in.read()
+        stats_by_file[filename] = get_empty_stats(transformer.config)
+        transformer.get_transformed_tree(content, filename=filename, stats=stats_by_file[filename])
+    return stats_by_file
+
+
+def get_diff_edits(transformer, diff_str, root=""):
+    """ The edits of the math around the changed lines of each .tex file of the unified diff, by
+    filename as in the diff. Its paths are relative to root. The files are read as they are now,
+    not as in the diff. Files without edits are left out """
+    edits_by_file = {}
+    for filename, line_ranges in sorted(get_changed_lines(diff_str).items()):
+        if not filename.endswith(".tex"):
+            continue
+        path = os.path.join(root, filename)
+        if not os.path.isfile(path):
+            raise ValueError("'{}' of the diff doesn't exist in {}".format(filename, os.path.abspath(root)))
+        with io.open(path, 'r', encoding='utf-8') as file_in:
+            edits = transformer.get_changed_math_edits(file_in.read(), line_ranges)
+        if edits:
+            edits_by_file[filename] = edits
+    return edits_by_file
+
+
+def print_first_changes(transformer, filenames):
+    """ Prints file:line:column: rule for the first place a rule would change in each file. Returns
+    whether there was any. Nothing is written """
+    changed = False
+    for filename in filenames:
+        with io.open(filename, 'r', encoding='utf-8') as file_in:
+            change = transformer.get_first_change(file_in.read())
+        if change is not None:
+            sys.stdout.write("{}:{}:{}: {}\n".format(filename, change["line"], change["column"], change["type"]))
+            changed = True
+    return changed
+
+
+def read_diff(diff_filename, ref):
+    """ The diff from a file, stdin for "-", or else from git, and the directory its paths are
+    relative to. That's the top of the git repository for a given diff, like git writes them, or
+    the current directory outside of one """
+    if not diff_filename:
+        return get_git_diff(ref, ["*.tex"]), ""
+    if diff_filename == "-":
+        diff_str = io.open(sys.stdin.fileno(), 'r', encoding='utf-8', closefd=False).read()
+    else:
+        with io.open(diff_filename, 'r', encoding='utf-8') as file_in:
+            diff_str = file_in.read()
+    return diff_str, get_git_root() or ""
+
+
 def main():
     optimus_prime = Transformer()
+    args = get_arguments(sys.argv[1:])
+    if args["stats"]:
+        optimus_prime.config = get_config(optimus_prime.config, args)
+        sys.stdout.write(format_stats(get_files_stats(optimus_prime, args["<tex_file>"]), args["--format"]) + "\n")
+        return
+    if args["diff"]:
+        optimus_prime.config = get_config(optimus_prime.config, args)
+        edits_by_file = get_diff_edits(optimus_prime, *read_diff(args["<diff_file>"], args["--ref"]))
+        sys.stdout.write(json.dumps(edits_by_file, indent=2, sort_keys=True) + "\n")
+        return
+    if args["--check"]:
+        optimus_prime.config = get_config(optimus_prime.config, args)
+        return 1 if print_first_changes(optimus_prime, args["<tex_file>"]) else 0
     filename_in, filename_out, optimus_prime.config = parse_cmd_arguments(optimus_prime.config, parameters=sys.argv[1:])
 
-    with io.open(filename_in,  'r', encoding='utf-8') as file_in, \
-         io.open(filename_out, 'w', encoding='utf-8') as file_out:
-        file_content_transformed = optimus_prime.get_transformed_str(file_in.read(), filename=filename_in)
-        file_out.write(file_content_transformed)
+    with io.open(filename_in, 'r', encoding='utf-8') as file_in:
+        content = file_in.read()
+    if args["map"]:
+        print_mapped_logs(optimus_prime, content, filename_in, filename_out, args["<log_file>"])
+        return
+    stats = get_empty_stats(optimus_prime.config) if args["--stats"] else None
+    doc_tree = optimus_prime.get_transformed_tree(content, filename=filename_in, stats=stats)
+    write_if_changed(filename_out, [element["content"] for element in doc_tree])
+    if stats is not None:
+        output_format = "csv" if args["--stats"].lower().endswith(".csv") else "json"
+        with io.open(args["--stats"], 'w', encoding='utf-8') as stats_out:
+            stats_out.write(format_stats({filename_in: stats}, output_format))
 
 
 if __name__ == "__main__":
-    main()  # pragma: no cover
+    sys.exit(main())  # pragma: no cover
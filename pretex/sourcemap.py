@@ -0,0 +1,158 @@
+# coding=utf-8
+""" Maps positions in the output back to the input.
+
+A map is a pair of sorted lists (out_offsets, in_offsets) of anchors: out_offsets[i] in the output
+corresponds to in_offsets[i] in the input. Between two anchors, positions advance one by one, but
+never past the next anchor. So text that was copied maps exactly, and positions inside a
+replacement map into the replaced text. """
+from __future__ import unicode_literals
+import bisect
+import re
+from array import array
+
+
+def get_identity_map(length):
+    return [0, length], [0, length]
+
+
+def get_edits_map(edits, in_length, out_length):
+    """ Map of a string transformation given by sorted (in_start, in_end, out_start, out_end)
+    replacements """
+    out_offsets = [0]
+    in_offsets = [0]
+    for in_start, in_end, out_start, out_end in edits:
+        out_offsets.extend([out_start, out_end])
+        in_offsets.extend([in_start, in_end])
+    out_offsets.append(out_length)
+    in_offsets.append(in_length)
+    return out_offsets, in_offsets
+
+
+def get_line_insertions_map(in_str, out_str):
+    """ Map for transformations that keep the lines and only insert text into them or empty them,
+    like auto_align """
+    edits = []
+    out_line_start = 0
+    in_line_start = 0
+    for in_line, out_line in zip(in_str.split("\n"), out_str.split("\n")):
+        in_pos = 0
+        for out_pos, char in enumerate(out_line):
+            if in_pos < len(in_line) and in_line[in_pos] == char:
+                in_pos += 1
+                continue
+            if edits and edits[-1][3] == out_line_start + out_pos and edits[-1][1] == in_line_start + in_pos:
+                edits[-1][3] += 1
+            else:
+                edits.append([in_line_start + in_pos, in_line_start + in_pos,
+                              out_line_start + out_pos, out_line_start + out_pos + 1])
+        if in_pos < len(in_line):
+            edits.append([in_line_start + in_pos, in_line_start + len(in_line),
+                          out_line_start + len(out_line), out_line_start + len(out_line)])
+        out_line_start += len(out_line) + 1
+        in_line_start += len(in_line) + 1
+    return get_edits_map(edits, len(in_str), len(out_str))
+
+
+def lookup(offsets_from, offsets_to, pos):
+    i = bisect.bisect_right(offsets_from, pos) - 1
+    if i < 0:
+        return offsets_to[0]
+    result = offsets_to[i] + pos - offsets_from[i]
+    if i + 1 < len(offsets_to):
+        result = min(result, offsets_to[i + 1])
+    return result
+
+
+def is_copied(offsets_from, offsets_to, pos):
+    """ Whether pos lies in a part that was copied 1:1 """
+    i = bisect.bisect_right(offsets_from, pos) - 1
+    if i < 0 or i + 1 >= len(offsets_from) or pos == offsets_from[i]:
+        return True
+    return offsets_from[i + 1] - offsets_from[i] == offsets_to[i + 1] - offsets_to[i]
+
+
+def normalize_anchors(anchors):
+    """ Sorted anchor pairs without the ones that would make the input offsets decrease """
+    out_offsets = []
+    in_offsets = []
+    for out_offset, in_offset in sorted(anchors):
+        if in_offsets and in_offset < in_offsets[-1]:
+            continue
+        out_offsets.append(out_offset)
+        in_offsets.append(in_offset)
+    return out_offsets, in_offsets
+
+
+def compose_maps(outer, inner):
+    """ outer maps x to y, inner maps y to z. Returns the map of x to z """
+    outer_out, outer_in = outer
+    inner_out, inner_in = inner
+    anchors = [(x, lookup(inner_out, inner_in, y)) for x, y in zip(outer_out, outer_in)]
+    anchors.extend((lookup(outer_in, outer_out, y), z) for y, z in zip(inner_out, inner_in)
+                   if is_copied(outer_in, outer_out, y))
+    return normalize_anchors(anchors)
+
+
+def compose_all(maps):
+    """ Map of the result of several transformations, given in the order they were applied """
+    total = maps[0]
+    for source_map in maps[1:]:
+        total = compose_maps(source_map, total)
+    return total
+
+
+def shift_map(source_map, out_shift, in_shift):
+    return [x + out_shift for x in source_map[0]], [y + in_shift for y in source_map[1]]
+
+
+def get_line_starts(text):
+    return array(str("L"), [0] + [match.end() for match in re.finditer("\n", text)])
+
+
+class SourceMap(object):
+    """ Translates line/column positions in the output file to the input file. Lines and columns
+    start at 1 like in editors and LaTeX logs """
+
+    def __init__(self, offsets_map, in_text, out_text):
+        self.out_offsets = array(str("L"), offsets_map[0])
+        self.in_offsets = array(str("L"), offsets_map[1])
+        self.in_line_starts = get_line_starts(in_text)
+        self.out_line_starts = get_line_starts(out_text)
+
+
+    def get_input_offset(self, out_offset):
+        return lookup(self.out_offsets, self.in_offsets, out_offset)
+
+
+    def get_input_position(self, line, column=1):
+        """ (line, column) in the input for a (line, column) in the output """
+        line_index = min(max(line - 1, 0), len(self.out_line_starts) - 1)
+        in_offset = self.get_input_offset(self.out_line_starts[line_index] + column - 1)
+        in_line_index = bisect.bisect_right(self.in_line_starts, in_offset) - 1
+        return in_line_index + 1, in_offset - self.in_line_starts[in_line_index] + 1
+
+
+    def get_input_line(self, line):
+        return self.get_input_position(line)[0]
+
+
+def translate_log(log_str, source_map, output_filename, input_filename):
+    """ Replaces the line numbers of a LaTeX log that refer to the output file with the ones of
+    the input file. These are "l.<n>" error contexts, "on input line <n>", "at lines <n>--<m>" and
+    file-line-error style "<output_filename>:<n>:". Only use with logs of a single file, the log
+    doesn't tell reliably which file the other line numbers refer to """
+    def repl_line(match):
+        return match.group(1) + str(source_map.get_input_line(int(match.group(2))))
+
+    def repl_lines(match):
+        return "{}{}--{}".format(match.group(1), source_map.get_input_line(int(match.group(2))),
+                                 source_map.get_input_line(int(match.group(3))))
+
+    def repl_file_line(match):
+        return "{}{}:{}:".format(match.group(1), input_filename, source_map.get_input_line(int(match.group(2))))
+
+    log_str = re.sub(r"(?m)(^l\.)(\d+)", repl_line, log_str)
+    log_str = re.sub(r"(on input line )(\d+)", repl_line, log_str)
+    log_str = re.sub(r"(at lines )(\d+)--(\d+)", repl_lines, log_str)
+    log_str = re.sub(r"(?m)(^|\W)" + re.escape(output_filename) + r":(\d+):", repl_file_line, log_str)
+    return log_str
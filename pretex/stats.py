@@ -0,0 +1,147 @@
+# coding=utf-8
+""" Statistics of transformations, for finding rules that never fire on a corpus or fire
+suspiciously often in some documents. Sizes are in characters of the decoded text """
+from __future__ import unicode_literals
+import csv
+import io
+import json
+from contextlib import contextmanager
+from timeit import default_timer
+from .trafos import get_rules
+try:
+    import tracemalloc
+except ImportError:  # python 2
+    tracemalloc = None
+
+
+def get_empty_stats(config=None):
+    """ Statistics with a zero entry for every enabled rule of the config """
+    rules = {}
+    if config is not None:
+        rules = {rule[0]: get_empty_rule_stats() for rule in get_rules(config) if config[rule[0]] != "disabled"}
+        if config["auto_align"] != "disabled":
+            rules["auto_align"] = get_empty_rule_stats()
+    return {"files": 0, "chars_in": 0, "chars_out": 0, "environments": {}, "rules": rules, "seconds": {}}
+
+
+def get_empty_rule_stats():
+    """ "skipped" counts the passes of the rule that didn't run at all, because none of their
+    triggers was in the math environment """
+    return {"matches": 0, "chars_changed": 0, "skipped": 0}
+
+
+@contextmanager
+def timed(stats, stage):
+    """ Adds the time spent in the with block to the stage, if there are stats. If they have a
+    "memory" dict, the memory the block allocated and its peak are added too, see get_memory_stats """
+    if stats is None:
+        yield
+        return
+    memory = stats.get("memory")
+    if memory is not None:
+        start_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+    start = default_timer()
+    yield
+    stats["seconds"][stage] = stats["seconds"].get(stage, 0.0) + default_timer() - start
+    if memory is not None:
+        size, peak = tracemalloc.get_traced_memory()
+        stage_memory = memory.setdefault(stage, {"allocated": 0, "peak": 0})
+        stage_memory["allocated"] += size - start_size
+        stage_memory["peak"] = max(stage_memory["peak"], peak - start_size)
+
+
+def get_memory_stats(transformer, content, filename="unknown"):
+    """ Memory used for transforming content, in bytes per byte of utf-8 input, measured with
+    tracemalloc: {stage: {"allocated", "peak"}} for the stages of get_transformed_tree, "join" for
+    joining the output and "total" for all of it. "allocated" is what is still held after a stage,
+    "peak" the most that was held on top of what was there before. Needs python 3.9 """
+    if tracemalloc is None or not hasattr(tracemalloc, "reset_peak"):
+        raise RuntimeError("Measuring memory needs tracemalloc.reset_peak from python 3.9")
+    input_size = max(len(content.encode("utf-8")), 1)
+    transformer.get_transformed_tree(content, filename)  # so that filling the caches doesn't count
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        stats = get_empty_stats(transformer.config)
+        stats["memory"] = memory = {}
+        doc_tree = transformer.get_transformed_tree(content, filename, stats=stats)
+        with timed(stats, "join"):
+            output = "".join([element["content"] for element in doc_tree])
+        del doc_tree, output
+
+        # the stages reset the peak, so the total needs a run of its own
+        start_size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        output = "".join([element["content"] for element in transformer.get_transformed_tree(content, filename)])
+        size, peak = tracemalloc.get_traced_memory()
+        memory["total"] = {"allocated": size - start_size, "peak": peak - start_size}
+        del output
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    return {stage: {key: value / float(input_size) for key, value in stage_memory.items()}
+            for stage, stage_memory in memory.items()}
+
+
+def add_math_stats(stats, env_type, content, trafos, skips=None):
+    environment = stats["environments"].setdefault(env_type, {"count": 0, "unchanged": 0})
+    environment["count"] += 1
+    if not trafos:
+        environment["unchanged"] += 1
+    for trafo in trafos:
+        rule = stats["rules"].setdefault(trafo["type"], get_empty_rule_stats())
+        rule["matches"] += 1
+        rule["chars_changed"] += len(content[trafo["start"]:trafo["end"]])
+    for name, count in (skips or {}).items():
+        stats["rules"].setdefault(name, get_empty_rule_stats())["skipped"] += count
+
+
+def add_stats(total, stats):
+    """ Adds stats to the total, both as from get_empty_stats """
+    for key in ["files", "chars_in", "chars_out"]:
+        total[key] += stats[key]
+    for group in ["environments", "rules"]:
+        for name, counts in stats[group].items():
+            total_counts = total[group].setdefault(name, dict.fromkeys(counts, 0))
+            for key, value in counts.items():
+                total_counts[key] += value
+    for stage, seconds in stats["seconds"].items():
+        total["seconds"][stage] = total["seconds"].get(stage, 0.0) + seconds
+    return total
+
+
+def get_stats_rows(stats):
+    """ (category, name, value) rows of the stats """
+    rows = [("size", key, stats[key]) for key in ["files", "chars_in", "chars_out"]]
+    for group, prefix in [("environments", "environment_"), ("rules", "rule_")]:
+        for name in sorted(stats[group]):
+            rows.extend((prefix + key, name, value) for key, value in sorted(stats[group][name].items()))
+    rows.extend(("seconds", stage, stats["seconds"][stage]) for stage in sorted(stats["seconds"]))
+    return rows
+
+
+def check_stats_format(output_format):
+    if output_format not in ["json", "csv"]:
+        raise ValueError("Unknown stats format '{}', use json or csv".format(output_format))
+
+
+def format_stats(stats_by_file, output_format="json"):
+    """ json with the "total" and the stats of the "files", or csv with a file,category,name,value
+    row for every number. The total is the file "total" there """
+    check_stats_format(output_format)
+    total = get_empty_stats()
+    for stats in stats_by_file.values():
+        add_stats(total, stats)
+
+    if output_format == "json":
+        return json.dumps({"total": total, "files": stats_by_file}, indent=2, sort_keys=True)
+
+    output = io.BytesIO() if str is bytes else io.StringIO()
+    writer = csv.writer(output, lineterminator="\n")
+    writer.writerow(["file", "category", "name", "value"])
+    for filename, stats in sorted(stats_by_file.items()) + [("total", total)]:
+        writer.writerows([filename] + list(row) for row in get_stats_rows(stats))
+    result = output.getvalue()
+    return result.decode("utf-8") if isinstance(result, bytes) else result
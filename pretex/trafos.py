@@ -1,5 +1,18 @@
 # coding=utf-8
+import bisect
+import io
+import json
 import re
+from .mathtree import parse_math, join_math, get_node_map
+from .sourcemap import get_identity_map, get_edits_map, get_line_insertions_map, compose_maps, compose_all
+try:
+    from itertools import accumulate
+except ImportError:  # python 2
+    def accumulate(values):
+        total = 0
+        for value in values:
+            total += value
+            yield total
 
 
 re_dot_special = re.compile(r"""
@@ -7,7 +20,7 @@ re_dot_special = re.compile(r"""
 (?P<content>
 \\\w+?|             #\word.. b
 \\vec\ \w|          #\vec p.. b
-\\vec\{[^\{\}]+\} #\vec{abc}.. b. no nested {} because that's impossible in regex
+\\vec\{[^\{\}]+\} #\vec{abc}.. b. nested groups are hidden, see mathtree
 )
 \.
 (?=$|\ |\n|,|\)|\})
@@ -18,7 +31,7 @@ re_ddot_special = re.compile(r"""
 (?P<content>
 \\\w+?|             #\word.. b
 \\vec\ \w|          #\vec p.. b
-\\vec\{[^\{\}]+\} #\vec{abc}.. b. no nested {} because that's impossible in regex
+\\vec\{[^\{\}]+\} #\vec{abc}.. b. nested groups are hidden, see mathtree
 )
 \.\.
 (?=$|\ |\n|,|\)|\})
@@ -90,7 +103,7 @@ re_braket_ket = re.compile(r"""
 (?P<ket>
     \|(?P<ket_c>[^\|\ {}<>\n]+)>
 )
-(?P<after>$|\ |\n|\)|\})
+(?=$|\ |\n|\)|\})
 """, re.VERBOSE)
 
 re_braket_bra = re.compile(r"""
@@ -98,7 +111,7 @@ re_braket_bra = re.compile(r"""
 (?P<bra>
     <(?P<bra_c>[^\|\ {}<>]+)\|
 )
-(?P<after>$|\ |\n|\)|\})
+(?=$|\ |\n|\)|\})
 """, re.VERBOSE)
 
 re_sub_superscript = re.compile(r"""
@@ -134,18 +147,87 @@ re_sub_brackets = re.compile(r"""
 
 re_sub_substack = re.compile(r"""
 _\ *?\{
-(?P<a>[^{}]*?) \\\\
-(?P<b>[^{}]*?) \}
+(?P<content>[^{}]*) # a hidden group or plain contents
+\}
 """, re.VERBOSE)
 
+re_left_bracket = re.compile(r"(?<!\\left)\(")
+re_right_bracket = re.compile(r"(?<!\\right)\)")
+
 re_sub_arrow = re.compile(r"""
 \ ->\^\{(?P<top>[^{}].*?)\}
 """, re.VERBOSE)
 
 
-def transform_main(math_string, config):
-    trafos = []
-    re_transformations = [
+# substrings of which at least one has to be in a string for the regex to match there
+rule_triggers = {
+    re_ddot_special: ("..",),
+    re_dot_special: (".",),
+    re_ddot_normal: ("..",),
+    re_dot_normal: (".",),
+    re_frac: ("\\frac",),
+    re_cdot: ("*",),
+    re_dots: ("...",),
+    re_sub_substack: ("_",),
+    re_left_bracket: ("(",),
+    re_right_bracket: (")",),
+    re_braket_full: ("|",),
+    re_braket_ketbra: ("|",),
+    re_braket_ket: ("|",),
+    re_braket_bra: ("|",),
+    re_sub_arrow: (" ->^{",),
+    re_sub_superscript: ("_", "^"),
+    re_sub_superscript_agg: ("_", "^"),
+}
+
+
+# the built-in regexes can't tell a "\n" before or after a match from the start or end of the string,
+# which makes them safe for transform_main_batch. User regexes might look further
+batch_safe_patterns = frozenset(rule_triggers)
+
+
+# cheap regexes that find something in the plain math string wherever the rule matches in the text
+# of one of its groups, see mathtree. If none of them finds anything, the groups needn't be parsed
+re_dot_prefilter = re.compile(r"[\w}]\.")
+rule_prefilters = {
+    re_ddot_special: re_dot_prefilter,
+    re_dot_special: re_dot_prefilter,
+    re_ddot_normal: re_dot_prefilter,
+    re_dot_normal: re_dot_prefilter,
+    re_frac: re.compile(r"\\frac\ +[^\{\n]"),
+    re_cdot: re.compile(r"\*[\ \w\\\(]"),
+    re_dots: re.compile(r"\.{3}"),
+    re_sub_substack: re.compile(r"\\\\"),  # the replacement needs rows
+    re_left_bracket: re_left_bracket,
+    re_right_bracket: re_right_bracket,
+    re_braket_full: re.compile(r"<[^\|<>{]*[\|{]"),
+    re_braket_ketbra: re.compile(r"\|[^\|\ {}<>]+>\ *<"),
+    re_braket_ket: re.compile(r"\|[^\|\ {}<>\n]+>"),
+    re_braket_bra: re.compile(r"<[^\|\ {}<>]+\|"),
+    re_sub_arrow: re.compile(r"\ ->\^\{"),
+    re_sub_superscript: re.compile(r"[_\^]\ *[a-zA-Z0-9][a-zA-Z0-9\+\*\-]+(?:$|\ |\n|\|)"),
+    re_sub_superscript_agg: re_sub_superscript_agg,
+}
+
+
+def get_triggers(pattern):
+    """ The trigger substrings of a rule pattern, None if it can't be ruled out that way """
+    if not hasattr(pattern, "search"):
+        return (pattern,)
+    return rule_triggers.get(pattern)
+
+
+def substack_repl(match, groups):
+    """ Two or more rows, separated by \\\\ outside of any nested group """
+    if "\\\\" not in groups.get(match.group("content"), match.group("content")):
+        return None
+    return "_{\\substack{" + match.group("content") + "}} "
+
+
+def get_builtin_rules(config):
+    """ The built-in (name, pattern, replacement) rules in the order they're applied. A str pattern
+    is a literal replacement, a compiled one a regex with a template replacement """
+    rules = [
         ("dot", re_ddot_special, r"\g<before>\\ddot{\g<content>}"),
         ("dot", re_dot_special, r"\g<before>\\dot{\g<content>}"),
         ("dot", re_ddot_normal, r"\g<before>\\ddot{\g<content>}"),
@@ -154,14 +236,14 @@ def transform_main(math_string, config):
         ("frac", re_frac, r"\\frac{\g<num>}{\g<denom>}"),
         ("cdot", re_cdot, r"\\cdot "),
         ("dots", re_dots, r"\\dots "),
-        ("substack", re_sub_substack, r"_{\\substack{\g<a>\\\\\g<b>}} "),
-        ("brackets", re.compile(r"(?<!\\left)\("), r"\\left("),
-        ("brackets", re.compile(r"(?<!\\right)\)"), r"\\right)"),
+        ("substack", re_sub_substack, substack_repl),
+        ("brackets", re_left_bracket, r"\\left("),
+        ("brackets", re_right_bracket, r"\\right)"),
 
         ("braket", re_braket_full, r"\\braket{\1}"),
         ("braket", re_braket_ketbra, r"\\ket{\g<ket_c>}\g<between>\\bra{\g<bra_c>}"),
-        ("braket", re_braket_ket, r"\g<before>\\ket{\g<ket_c>}\g<after>"),
-        ("braket", re_braket_bra, r"\g<before>\\bra{\g<bra_c>}\g<after>"),
+        ("braket", re_braket_ket, r"\g<before>\\ket{\g<ket_c>}"),
+        ("braket", re_braket_bra, r"\g<before>\\bra{\g<bra_c>}"),
 
         # simple replacements using str.replace(), not regex
         ("arrow", r" -> ", r" \to "),
@@ -173,36 +255,512 @@ def transform_main(math_string, config):
         ("neq", r"!=", r"\neq ")
     ]
     if config["arrow"] == "enabled":
-        re_transformations.append(("arrow", re_sub_arrow, r" \\xrightarrow{\g<top>}"))
+        rules.append(("arrow", re_sub_arrow, r" \\xrightarrow{\g<top>}"))
     if config["sub_superscript"] == "enabled":
-        re_transformations.append(("sub_superscript", re_sub_superscript, r"\g<operator>\g<before>{\g<content>}\g<after>"))
+        rules.append(("sub_superscript", re_sub_superscript, r"\g<operator>\g<before>{\g<content>}\g<after>"))
     elif config["sub_superscript"] == "aggressive":
-        re_transformations.extend([
+        rules.extend([
             ("sub_superscript", re_sub_superscript_agg, r"\g<operator>\g<before>{\g<content>}\g<after>"),
             ("sub_superscript", re_sub_superscript, r"\g<operator>\g<before>{\g<content>}\g<after>")
         ])
-
-    for name, pattern, repl in re_transformations:
-        if config[name] != "disabled":
-            if isinstance(pattern, str):
-                match_pos = math_string.find(pattern)
-                while match_pos != -1:
-                    trafos.append({"type": name, "start": match_pos, "end": match_pos+len(repl)})
-                    math_string = math_string.replace(pattern, repl, 1)
-                    match_pos = math_string.find(pattern)
-
+    return rules
+
+
+BUILTIN_RULE_NAMES = ("dot", "frac", "cdot", "dots", "substack", "brackets", "braket", "arrow", "approx", "leq",
+                      "geq", "ll", "gg", "neq", "sub_superscript")
+_rules_file_cache = {}
+
+
+def load_rules_file(filename):
+    r""" Reads user defined rules from a json file like
+
+        {"rules": [
+            {"name": "leftrightarrow", "pattern": "<->", "replacement": "\\leftrightarrow "},
+            {"name": "reals", "pattern": "\\bR\\^", "replacement": "\\\\mathbb{R}^", "regex": true,
+             "before": "sub_superscript", "default": "enabled"}
+        ]}
+
+    "name" is also the config key that enables the rule. Literal rules replace the pattern as is, regex
+    rules use re templates. Regex rules can have "triggers", a list of strings of which one has to be
+    in the math for the rule to match, so it can be skipped otherwise. Rules are appended after the
+    built-in ones unless "before" or "after" names another rule. Files are only read once per process """
+    if not filename:
+        return []
+    if filename not in _rules_file_cache:
+        with io.open(filename, 'r', encoding='utf-8') as file_in:
+            rule_defs = json.load(file_in).get("rules", [])
+
+        user_rules = []
+        known_names = set(BUILTIN_RULE_NAMES)
+        for rule_def in rule_defs:
+            if not rule_def.get("name") or not rule_def.get("pattern") or "replacement" not in rule_def:
+                raise ValueError("Rules need a name, pattern and replacement: {}".format(rule_def))
+            if rule_def["name"] in BUILTIN_RULE_NAMES:
+                raise ValueError("Rule name '{}' is already a built-in rule".format(rule_def["name"]))
+            for position_key in ["before", "after"]:
+                if rule_def.get(position_key) is not None and rule_def[position_key] not in known_names:
+                    raise ValueError("Unknown rule '{}' for '{}'".format(rule_def[position_key], position_key))
+            try:
+                pattern = re.compile(rule_def["pattern"]) if rule_def.get("regex") else rule_def["pattern"]
+            except re.error as error:
+                raise ValueError("Invalid regex in rule '{}': {}".format(rule_def["name"], error))
+            if rule_def.get("triggers") is not None and rule_def.get("regex"):
+                if not rule_def["triggers"] or not all(rule_def["triggers"]):
+                    raise ValueError("Triggers of rule '{}' have to be non-empty strings".format(rule_def["name"]))
+                rule_triggers[pattern] = tuple(rule_def["triggers"])
+            user_rules.append({"name": rule_def["name"], "pattern": pattern, "repl": rule_def["replacement"],
+                               "default": rule_def.get("default", "enabled"),
+                               "before": rule_def.get("before"), "after": rule_def.get("after")})
+            known_names.add(rule_def["name"])
+        _rules_file_cache[filename] = user_rules
+    return _rules_file_cache[filename]
+
+
+def get_user_rule_defaults(filename):
+    return {user_rule["name"]: user_rule["default"] for user_rule in load_rules_file(filename)}
+
+
+def get_rules(config):
+    """ Built-in rules with the user rules from config["rules_file"] inserted at their positions """
+    rules = get_builtin_rules(config)
+    for user_rule in load_rules_file(config.get("rules_file")):
+        rule = (user_rule["name"], user_rule["pattern"], user_rule["repl"])
+        names = [name for name, _, _ in rules]
+        if user_rule["before"] in names:
+            rules.insert(names.index(user_rule["before"]), rule)
+        elif user_rule["after"] in names:
+            rules.insert(len(names) - names[::-1].index(user_rule["after"]), rule)
+        else:
+            rules.append(rule)
+    return rules
+
+
+def overlapping(a, b):
+    """ Whether the strings a and b can overlap in some text: one contains the other or an end of one
+    is the start of the other """
+    if a in b or b in a:
+        return True
+    return any(a.endswith(b[:i]) or b.endswith(a[:i]) for i in range(1, min(len(a), len(b))))
+
+
+def prepare_rules(rules):
+    """ Turns the ordered rules into passes over the math string. Consecutive literal rules are fused
+    into a single regex alternation pass as long as that gives the same result as running them one
+    after another: No pattern may overlap another one in the same pass, and no replacement may
+    produce a pattern. Literal rules whose replacement can form their own pattern again and the
+    regex rules keep their own pass which rescans the output. Each pass gets the triggers of its
+    rules, None if one of them has none """
+    passes = []
+    for rule_index, (name, pattern, repl) in enumerate(rules):
+        if hasattr(pattern, "search"):
+            passes.append(("regex", [(rule_index, name, pattern, repl)]))
+            continue
+
+        if not repl or overlapping(pattern, repl):
+            # the replacement can form a new match, needs a rescan after each replacement
+            passes.append(("literal_rescan", [(rule_index, name, pattern, repl)]))
+            continue
+
+        if passes and passes[-1][0] == "literal":
+            fused = passes[-1][1]
+            if not any(overlapping(pattern, other_pattern) or overlapping(pattern, other_repl)
+                       for _, _, other_pattern, other_repl in fused):
+                fused.append((rule_index, name, pattern, repl))
+                continue
+        passes.append(("literal", [(rule_index, name, pattern, repl)]))
+
+    prepared_passes = []
+    for kind, members in passes:
+        fused_pattern = re.compile("|".join(re.escape(pattern) for _, _, pattern, _ in members)) if kind == "literal" else None
+        member_triggers = [get_triggers(pattern) for _, _, pattern, _ in members]
+        triggers = None if None in member_triggers else tuple(trigger for triggers in member_triggers for trigger in triggers)
+        prepared_passes.append((kind, members, fused_pattern, triggers))
+    return prepared_passes
+
+
+def get_any_rule_patterns(rule_passes):
+    """ The patterns of all passes combined into one alternation per regex flags. If none of them
+    matches a string, no rule can change it. None if some pattern can't be combined, because it
+    refers to its groups or sets flags inline """
+    sources_by_flags = {}
+    for kind, members, _, _ in rule_passes:
+        for _, _, pattern, _ in members:
+            if hasattr(pattern, "search"):
+                if re.search(r"\(\?P=|\(\?\(|\\\d|\(\?[aiLmsux]", pattern.pattern):
+                    return None
+                source = re.sub(r"\(\?P<\w+>", "(?:", pattern.pattern)
+                flags = pattern.flags
             else:
-                match = pattern.search(math_string)
-                while match:
-                    match_expanded = match.expand(repl)
-                    trafos.append({"type": name, "start": match.start(), "end": match.start()+len(match_expanded)})
-                    math_string = math_string[:match.start()] + match_expanded + math_string[match.end():]
-                    match = pattern.search(math_string, match.end())
-
+                source = re.escape(pattern)  # escapes whitespace and #, so it's fine in verbose mode too
+                flags = re.VERBOSE
+            sources_by_flags.setdefault(flags, []).append("(?:" + source + "\n)" if flags & re.VERBOSE else
+                                                          "(?:" + source + ")")
+    return [re.compile("|".join(sources), flags) for flags, sources in sources_by_flags.items()]
+
+
+_prepared_rules_cache = {}
+_pass_prefilters_cache = {}
+
+
+def get_trigger_index(rule_passes):
+    """ (trigger, indices of the passes it can start) for every distinct trigger, the passes without
+    triggers and all passes """
+    trigger_passes = {}
+    untriggered_passes = set()
+    for pass_index, (_, _, _, triggers) in enumerate(rule_passes):
+        if triggers is None:
+            untriggered_passes.add(pass_index)
+        for trigger in triggers or ():
+            trigger_passes.setdefault(trigger, set()).add(pass_index)
+    return ([(trigger, frozenset(pass_indices)) for trigger, pass_indices in sorted(trigger_passes.items())],
+            frozenset(untriggered_passes), frozenset(range(len(rule_passes))))
+
+
+def get_config_key(config):
+    """ A Config is its own cache key, plain dicts are frozen for the lookup """
+    return config if getattr(config, "__hash__", None) else frozenset(config.items())
+
+
+def get_prepared_rules(config):
+    """ The prepared passes of all enabled rules, their combined patterns and their trigger index,
+    cached per config """
+    config_key = get_config_key(config)
+    prepared_rules = _prepared_rules_cache.get(config_key)
+    if prepared_rules is None:
+        enabled_rules = [rule for rule in get_rules(config) if config[rule[0]] != "disabled"]
+        rule_passes = prepare_rules(enabled_rules)
+        prepared_rules = rule_passes, get_any_rule_patterns(rule_passes), get_trigger_index(rule_passes)
+        _prepared_rules_cache[config_key] = prepared_rules
+    return prepared_rules
+
+
+def get_pass_prefilters(config):
+    """ A regex for each prepared pass that finds something in the plain math string if the pass can
+    match in one of its groups, see rule_prefilters. None for the passes of user regexes. Cached per
+    config """
+    config_key = get_config_key(config)
+    pass_prefilters = _pass_prefilters_cache.get(config_key)
+    if pass_prefilters is None:
+        pass_prefilters = []
+        for kind, members, fused_pattern, _ in get_prepared_rules(config)[0]:
+            pattern = members[0][2]
+            if kind == "literal":
+                pass_prefilters.append(fused_pattern)
+            elif kind == "literal_rescan":
+                pass_prefilters.append(re.compile(re.escape(pattern)))
+            else:
+                pass_prefilters.append(rule_prefilters.get(pattern))
+        _pass_prefilters_cache[config_key] = pass_prefilters
+    return pass_prefilters
+
+
+def apply_literal_pass(math_string, members, fused_pattern, trafos, maps=None):
+    """ replaces all patterns of the fused literal rules in one scan. If maps is a list, the map of
+    the result to math_string is appended, see sourcemap """
+    replacements = {pattern: (rule_index, name, repl) for rule_index, name, pattern, repl in members}
+    pass_trafos = []
+    edits = []
+    pieces = []
+    last_end = 0
+    offset = 0
+    for match in fused_pattern.finditer(math_string):
+        rule_index, name, repl = replacements[match.group(0)]
+        start = match.start() + offset
+        pass_trafos.append((rule_index, {"type": name, "start": start, "end": start+len(repl)}))
+        if maps is not None:
+            edits.append((match.start(), match.end(), start, start+len(repl)))
+        pieces.append(math_string[last_end:match.start()])
+        pieces.append(repl)
+        last_end = match.end()
+        offset += len(repl) - len(match.group(0))
+
+    if not pieces:
+        return math_string
+    pieces.append(math_string[last_end:])
+    trafos.extend(trafo for _, trafo in sorted(pass_trafos, key=lambda x: x[0]))
+    if maps is not None:
+        maps.append(get_edits_map(edits, len(math_string), len(math_string) + offset))
+    return "".join(pieces)
+
+
+def apply_literal_rescan_pass(math_string, name, pattern, repl, trafos, maps=None):
+    """ replaces the pattern until there's none left. A new match can only start less than
+    len(pattern) chars before the last replacement, so only those and the replacement are searched
+    again in a small window before the scan goes on in the rest of the string. The done text is
+    kept as [text, start, end] slices, the window takes its chars back from their ends, and the
+    result is joined once """
+    slices = []
+    done_len = 0  # length of the slices, the window comes after them and math_string[pos:] after it
+    window = ""
+    pos = 0
+    carry = len(pattern) - 1
+    string_len = len(math_string)
+    while True:
+        match_pos = (window + math_string[pos:pos + carry]).find(pattern)
+        if match_pos == -1:
+            next_pos = math_string.find(pattern, pos)
+            if next_pos == -1:
+                break
+            slices.extend([[window, 0, len(window)], [math_string, pos, next_pos]])
+            done_len += len(window) + next_pos - pos
+            window = ""
+            match_pos = 0
+            pos = next_pos
+        start = done_len + match_pos
+        trafos.append({"type": name, "start": start, "end": start+len(repl)})
+        if maps is not None:
+            maps.append(get_edits_map([(start, start+len(pattern), start, start+len(repl))],
+                                      string_len, string_len + len(repl) - len(pattern)))
+        string_len += len(repl) - len(pattern)
+        match_end = match_pos + len(pattern)
+        pos += max(0, match_end - len(window))
+        window = window[:match_pos] + repl + window[match_end:]
+
+        # the window starts carry chars before the replacement, taking them back from the slices
+        taken_back = []
+        while match_pos < carry and slices:
+            text, slice_start, slice_end = slices[-1]
+            count = min(carry - match_pos, slice_end - slice_start)
+            taken_back.append(text[slice_end - count:slice_end])
+            if count == slice_end - slice_start:
+                slices.pop()
+            else:
+                slices[-1][2] = slice_end - count
+            match_pos += count
+            done_len -= count
+        window = "".join(reversed(taken_back)) + window
+        keep_from = match_pos - carry if match_pos > carry else 0
+        slices.append([window, 0, keep_from])
+        done_len += keep_from
+        window = window[keep_from:]
+    slices.extend([[window, 0, len(window)], [math_string, pos, len(math_string)]])
+    return "".join(text[slice_start:slice_end] for text, slice_start, slice_end in slices)
+
+
+def apply_regex_pass(math_string, name, pattern, repl, groups, trafos, maps=None):
+    """ replaces all matches in one scan. repl is a template or a function getting the match and
+    the hidden groups, returning the replacement or None to leave the match alone """
+    first_match = pattern.search(math_string)
+    if not first_match:
+        return math_string
+
+    edits = []
+    pieces = []
+    last_end = 0
+    offset = 0
+    for match in pattern.finditer(math_string, first_match.start()):
+        match_expanded = repl(match, groups) if callable(repl) else match.expand(repl)
+        if match_expanded is None:
+            continue
+        start = match.start() + offset
+        trafos.append({"type": name, "start": start, "end": start+len(match_expanded)})
+        if maps is not None:
+            edits.append((match.start(), match.end(), start, start+len(match_expanded)))
+        pieces.append(math_string[last_end:match.start()])
+        pieces.append(match_expanded)
+        last_end = match.end()
+        offset += len(match_expanded) - (match.end() - match.start())
+
+    if not pieces:
+        return math_string
+    pieces.append(math_string[last_end:])
+    if maps is not None:
+        maps.append(get_edits_map(edits, len(math_string), len(math_string) + offset))
+    return "".join(pieces)
+
+
+def apply_pass(math_string, kind, members, fused_pattern, groups, trafos, maps=None):
+    if kind == "literal":
+        return apply_literal_pass(math_string, members, fused_pattern, trafos, maps)
+    _, name, pattern, repl = members[0]
+    if kind == "literal_rescan":
+        return apply_literal_rescan_pass(math_string, name, pattern, repl, trafos, maps)
+    return apply_regex_pass(math_string, name, pattern, repl, groups, trafos, maps)
+
+
+def has_trigger(math_string, triggers):
+    return triggers is None or any(trigger in math_string for trigger in triggers)
+
+
+def get_skipped_passes(math_string, rule_passes, trigger_index, skips=None):
+    """ Indices of the passes none of whose triggers are in the math string. Each distinct trigger
+    is searched once. skips is an optional dict counting the skipped passes per rule name """
+    trigger_passes, active_passes, all_passes = trigger_index
+    for trigger, pass_indices in trigger_passes:
+        if trigger in math_string:
+            active_passes = active_passes.union(pass_indices)
+    skipped = all_passes.difference(active_passes)
+    if skips is not None:
+        for pass_index in skipped:
+            for _, name, _, _ in rule_passes[pass_index][1]:
+                skips[name] = skips.get(name, 0) + 1
+    return skipped
+
+
+def apply_rules(math_string, rule_passes, groups, maps=None, skipped=()):
+    """ Applies the passes except the skipped ones. Once a pass changed the string, the skipped ones
+    are checked again, because the replacement can contain their triggers """
+    trafos = []
+    pass_maps = [get_identity_map(len(math_string))] if maps is not None else None
+    original_string = math_string
+    for pass_index, (kind, members, fused_pattern, triggers) in enumerate(rule_passes):
+        if pass_index in skipped and (math_string is original_string or not has_trigger(math_string, triggers)):
+            continue
+        math_string = apply_pass(math_string, kind, members, fused_pattern, groups, trafos, pass_maps)
+    if maps is not None:
+        maps.append(compose_all(pass_maps))
     return math_string, trafos
 
 
-def transform_auto_align(math_string, config, env_type=None):
+def could_match(math_string, any_rule_patterns):
+    return any_rule_patterns is None or any(pattern.search(math_string) for pattern in any_rule_patterns)
+
+
+def could_change(math_string, pass_prefilters, skipped):
+    """ Whether one of the passes that aren't skipped can match in the groups of the math string.
+    As long as none matches, the string stays the same for the later passes too """
+    return any(prefilter is None or prefilter.search(math_string)
+               for pass_index, prefilter in enumerate(pass_prefilters) if pass_index not in skipped)
+
+
+def transform_main(math_string, config, maps=None, skips=None):
+    """ Applies all enabled rules in one walk over the brace groups of the math string, see
+    mathtree. Rules without any of their triggers in the math string are skipped, and so are groups
+    where no rule pattern matches at all. The groups are only parsed if a rule can match in one of
+    them. If maps is a list, the map of the result to math_string is appended. skips is an optional
+    dict counting the skipped passes per rule name """
+    rule_passes, any_rule_patterns, trigger_index = get_prepared_rules(config)
+    skipped = get_skipped_passes(math_string, rule_passes, trigger_index, skips)
+    if len(skipped) == len(rule_passes) or not could_change(math_string, get_pass_prefilters(config), skipped):
+        if maps is not None:
+            maps.append(get_identity_map(len(math_string)))
+        return math_string, []
+
+    nodes = parse_math(math_string)
+    if len(nodes) == 1:
+        if not could_match(math_string, any_rule_patterns):
+            if maps is not None:
+                maps.append(get_identity_map(len(math_string)))
+            return math_string, []
+        return apply_rules(math_string, rule_passes, {}, maps, skipped)
+
+    results = []
+    node_maps = [] if maps is not None else None
+    for node in nodes:
+        if could_match(node["text"], any_rule_patterns):
+            results.append(apply_rules(node["text"], rule_passes, node["groups"], node_maps, skipped))
+        else:
+            results.append((node["text"], []))
+            if node_maps is not None:
+                node_maps.append(get_identity_map(len(node["text"])))
+    if not any(trafos for _, trafos in results):
+        if maps is not None:
+            maps.append(get_identity_map(len(math_string)))
+        return math_string, []
+    if node_maps is not None:
+        node_maps = [compose_maps(node_map, get_node_map(nodes, node_index))
+                     for node_index, node_map in enumerate(node_maps)]
+    joined = join_math(nodes, results, node_maps)
+    if joined is None:
+        # a (user) rule didn't keep the groups intact, transform the plain string instead
+        return apply_rules(math_string, rule_passes, {}, maps, skipped)
+    if maps is not None:
+        maps.append(node_maps[0])
+    return joined
+
+
+def get_pass_matches(buffer, kind, members, fused_pattern):
+    """ (start, end) of the matches of a pass in the buffer. For literal_rescan passes all
+    occurrences of the pattern, even overlapping ones """
+    if kind == "literal":
+        return [match.span() for match in fused_pattern.finditer(buffer)]
+    pattern = members[0][2]
+    if kind == "regex":
+        return [match.span() for match in pattern.finditer(buffer)]
+    spans = []
+    start = buffer.find(pattern)
+    while start != -1:
+        spans.append((start, start + len(pattern)))
+        start = buffer.find(pattern, start + 1)
+    return spans
+
+
+def get_segment_starts(segments):
+    """ Offsets of the segments in "".join(segments) """
+    return [0] + list(accumulate(map(len, segments[:-1])))
+
+
+def get_touched_segments(starts, spans):
+    """ Indices of the segments at the starts which the (start, end) spans overlap. The segments end
+    with a "\n", a span starting there only touches the next one """
+    touched = set()
+    for start, end in spans:
+        first = bisect.bisect_right(starts, min(start + 1, end)) - 1
+        touched.update(range(first, bisect.bisect_right(starts, end)))
+    return touched
+
+
+def get_trigger_pattern(trigger_index):
+    """ A regex matching any of the triggers of the trigger index """
+    return re.compile("|".join(re.escape(trigger) for trigger, _ in trigger_index[0]) or "(?!)")
+
+
+def transform_main_batch(math_strings, config, skips=None):
+    """ transform_main for a list of math strings, with the same results. Instead of running every
+    pass on every group of every string, a pass scans the groups of all strings at once, joined by
+    "\n", and then only runs on the groups its matches touched. The built-in regexes can't tell
+    a "\n" from the start or end of a string, so no group with a match gets missed. Rule sets with
+    user regexes, which might, are transformed one by one. skips is an optional list with a dict
+    per math string, like for transform_main """
+    rule_passes, _, trigger_index = get_prepared_rules(config)
+    if skips is not None:
+        for math_string, string_skips in zip(math_strings, skips):
+            get_skipped_passes(math_string, rule_passes, trigger_index, string_skips)
+    if any(kind == "regex" and members[0][2] not in batch_safe_patterns for kind, members, _, _ in rule_passes):
+        return [transform_main(math_string, config) for math_string in math_strings]
+
+    # only the strings where the prefilter of a pass finds something and which contain one of its
+    # triggers can change, all passes have both here. Only they get parsed into groups
+    results = [(math_string, []) for math_string in math_strings]
+    segments = [math_string + "\n" for math_string in math_strings]
+    buffer = "".join(segments)
+    starts = get_segment_starts(segments)
+    candidates = set()
+    for (_, _, _, triggers), prefilter in zip(rule_passes, get_pass_prefilters(config)):
+        candidates.update(i for i in get_touched_segments(starts, (match.span() for match in prefilter.finditer(buffer)))
+                          if has_trigger(math_strings[i], triggers))
+    candidates = sorted(candidates)
+
+    string_nodes = [parse_math(math_strings[i]) for i in candidates]
+    node_groups = [node["groups"] for nodes in string_nodes for node in nodes]
+    segments = [node["text"] + "\n" for nodes in string_nodes for node in nodes]
+    node_trafos = [[] for _ in segments]
+    buffer = None
+    for kind, members, fused_pattern, _ in rule_passes:
+        if buffer is None:
+            buffer = "".join(segments)
+            starts = get_segment_starts(segments)
+        for i in get_touched_segments(starts, get_pass_matches(buffer, kind, members, fused_pattern)):
+            segment = apply_pass(segments[i][:-1], kind, members, fused_pattern, node_groups[i], node_trafos[i]) + "\n"
+            if segment != segments[i]:
+                segments[i] = segment
+                buffer = None
+
+    node_index = 0
+    for string_index, nodes in zip(candidates, string_nodes):
+        node_end = node_index + len(nodes)
+        if len(nodes) == 1:
+            results[string_index] = segments[node_index][:-1], node_trafos[node_index]
+        elif any(node_trafos[node_index:node_end]):
+            joined = join_math(nodes, [(segment[:-1], trafos) for segment, trafos in
+                                       zip(segments[node_index:node_end], node_trafos[node_index:node_end])])
+            # a rule that didn't keep the groups intact needs the plain string, see transform_main
+            results[string_index] = joined if joined is not None else transform_main(math_strings[string_index], config)
+        node_index = node_end
+    return results
+
+
+def transform_auto_align(math_string, config, env_type=None, maps=None):
     """ Trims the empty lines at the beginning at end. There have to be >=2
     "real" lines. For the &0, There have to be none of those already, and 0
     or 1 equal sign on every line. For the \\'s, there have to be none already.
@@ -215,6 +773,7 @@ def transform_auto_align(math_string, config, env_type=None):
         return line + r" \\" if not isempty(line) else ""
 
     trafos = []
+    original_string = math_string
     if env_type in ["align", "align*"] and config["auto_align"] != "disabled":
         lines = math_string.split("\n")
         i1 = next((i for i in range(len(lines)) if not isempty(lines[i])), None)
@@ -230,4 +789,6 @@ def transform_auto_align(math_string, config, env_type=None):
                     trafos = [{"type": "auto_align", "start": 0, "end": 1}]
                 math_string = "\n".join(lines)
 
+    if maps is not None:
+        maps.append(get_line_insertions_map(original_string, math_string))
     return math_string, trafos
@@ -0,0 +1,143 @@
+# coding=utf-8
+""" A compact binary format of doc trees, for caches and for sending them between processes.
+
+Integers are unsigned LEB128 varints (7 bits per byte, low bits first). Layout:
+
+    b"PTX" version(1 byte)
+    rule count, then each rule name as byte length + utf-8
+    byte length of the text + the utf-8 text of all elements one after the other
+    element count
+    per element: its length in characters << 1 | 1 for a math_env, 0 for text
+                 for a math_env: trafo count, then per trafo its rule index, start and
+                 zigzag(end - start)
+
+The rule names (trafo types) are stored once and referenced by their index. Keeping the text of all
+elements in one block means it's decoded with a single call, straight from the buffer when decoding
+a memoryview, and the elements are slices of it. """
+from __future__ import unicode_literals
+from array import array
+
+MAGIC = b"PTX"
+VERSION = 1
+
+
+def add_varint(buffer, value):
+    while value > 0x7f:
+        buffer.append(value & 0x7f | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+def read_varint(data, pos):
+    """ (value, position after it) of the varint at pos of the byte array data """
+    value = data[pos]
+    if value < 0x80:
+        return value, pos + 1
+    value &= 0x7f
+    shift = 7
+    while True:
+        pos += 1
+        byte = data[pos]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos + 1
+        shift += 7
+
+
+def encode_tree(doc_tree):
+    """ The doc tree in the binary format, as bytes """
+    rule_indices = {}
+    table = bytearray()
+    add_varint(table, len(doc_tree))
+    for element in doc_tree:
+        if element["type"] == "text":
+            add_varint(table, len(element["content"]) << 1)
+            continue
+        if element["type"] != "math_env":
+            raise ValueError("Unknown doc tree element type '{}'".format(element["type"]))
+        add_varint(table, len(element["content"]) << 1 | 1)
+        add_varint(table, len(element["pretexes"]))
+        for trafo in element["pretexes"]:
+            length = trafo["end"] - trafo["start"]
+            add_varint(table, rule_indices.setdefault(trafo["type"], len(rule_indices)))
+            add_varint(table, trafo["start"])
+            add_varint(table, length << 1 if length >= 0 else (-length << 1) - 1)
+
+    header = bytearray(MAGIC)
+    header.append(VERSION)
+    add_varint(header, len(rule_indices))
+    for name in sorted(rule_indices, key=rule_indices.get):
+        name_bytes = name.encode("utf-8")
+        add_varint(header, len(name_bytes))
+        header.extend(name_bytes)
+    text = "".join([element["content"] for element in doc_tree]).encode("utf-8")
+    add_varint(header, len(text))
+    return b"".join([bytes(header), text, bytes(table)])
+
+
+def decode_tree(data):
+    """ The doc tree of bytes, a bytearray or a memoryview in the binary format. A memoryview is
+    read without copying it first """
+    data = memoryview(data)
+    if data[:len(MAGIC)].tobytes() != MAGIC or len(data) <= len(MAGIC):
+        raise ValueError("Not a doc tree in the binary format")
+    ints = data if not isinstance(data[0], bytes) else array(str("B"), data.tobytes())  # python 2 gives bytes
+    if ints[len(MAGIC)] != VERSION:
+        raise ValueError("Unsupported doc tree format version {}".format(ints[len(MAGIC)]))
+    try:
+        return read_tree(data, ints, len(MAGIC) + 1)
+    except IndexError:
+        raise ValueError("Truncated doc tree data")
+
+
+def read_tree(data, ints, pos):
+    """ The doc tree of the binary format data, starting at pos after the header. ints are the
+    bytes of data as ints. The varints are mostly a single byte, that case is read inline """
+    rule_count, pos = read_varint(ints, pos)
+    rule_names = []
+    for _ in range(rule_count):
+        length, pos = read_varint(ints, pos)
+        rule_names.append(data[pos:pos + length].tobytes().decode("utf-8"))
+        pos += length
+    text_length, pos = read_varint(ints, pos)
+    if pos + text_length > len(data):
+        raise IndexError
+    text = decode_utf8(data[pos:pos + text_length])
+    pos += text_length
+
+    element_count, pos = read_varint(ints, pos)
+    doc_tree = []
+    text_pos = 0
+    for _ in range(element_count):
+        length = ints[pos]
+        pos += 1
+        if length >= 0x80:
+            length, pos = read_varint(ints, pos - 1)
+        content = text[text_pos:text_pos + (length >> 1)]
+        text_pos += length >> 1
+        if not length & 1:
+            doc_tree.append({"type": "text", "content": content})
+            continue
+        trafo_count, pos = read_varint(ints, pos)
+        trafos = []
+        for _ in range(trafo_count):
+            rule_index, start, zigzag_length = ints[pos], ints[pos + 1], ints[pos + 2]
+            if rule_index | start | zigzag_length < 0x80:
+                pos += 3
+            else:
+                rule_index, pos = read_varint(ints, pos)
+                start, pos = read_varint(ints, pos)
+                zigzag_length, pos = read_varint(ints, pos)
+            end = start + (zigzag_length >> 1 if not zigzag_length & 1 else -((zigzag_length + 1) >> 1))
+            trafos.append({"type": rule_names[rule_index], "start": start, "end": end})
+        doc_tree.append({"type": "math_env", "content": content, "pretexes": trafos})
+    if pos != len(data) or text_pos != len(text):
+        raise ValueError("Corrupt doc tree data")
+    return doc_tree
+
+
+def decode_utf8(view):
+    try:
+        return str(view, "utf-8")
+    except TypeError:  # python 2 can't decode buffers directly
+        return view.tobytes().decode("utf-8")
@@ -7,10 +7,20 @@ import json
 import sys
 import os
 import io
+import pickle
+import glob
+import subprocess
+from multiprocessing.pool import ThreadPool
 from pretex import pretex
-from pretex.Transformer import Transformer, get_document_contents, strip_comments, get_default_config, \
-    get_transformed_math
+from pretex.Transformer import Transformer, Config, get_document_contents, strip_comments, get_default_config, \
+    get_transformed_math, transform_math_batch
 from pretex.Transformer import get_inside_str
+from pretex.trafos import get_builtin_rules, prepare_rules, get_prepared_rules, get_skipped_passes
+from pretex.mathtree import parse_math, join_math, get_placeholder
+from pretex.sourcemap import translate_log
+from pretex.stats import get_empty_stats, format_stats, get_memory_stats
+from pretex.gitdiff import get_changed_lines
+from pretex.treeformat import encode_tree, decode_tree
 
 
 def silent_remove(filename):
@@ -163,8 +173,169 @@ a\cdot b
             "in.tex", "in_t.tex", config_expected)
 
 
+    def test_parallel(self):
+        with io.open("tests/test_file.tex", 'r', encoding='utf-8') as file_in:
+            test_str = file_in.read()
+        serial = Transformer()
+        parallel = Transformer()
+        parallel.config = parallel.config.replace(jobs="2")
+        parallel.parallel_min_size = 0
+        assert parallel.get_transformed_tree(test_str) == serial.get_transformed_tree(test_str)
+
+        config_expected = get_default_config()
+        config_expected["jobs"] = "4"
+        assert pretex.parse_cmd_arguments(get_default_config(), "in.tex -j 4".split()) == (
+            "in.tex", "in_t.tex", config_expected)
+        with pytest.raises(ValueError):
+            pretex.parse_cmd_arguments(get_default_config(), "in.tex -j 0".split())
+
+
+    def test_config(self, rules_file):
+        config = Config(dot="enabled")
+        assert config["dot"] == "enabled"
+        assert config["cdot"] == "enabled"
+        assert config == Config(get_default_config()).replace(dot="enabled")
+        assert hash(config) == hash(Config(dot="enabled"))
+        assert hash(config) != hash(Config())
+        assert pickle.loads(pickle.dumps(config)) == config
+        assert copy.deepcopy(config) is config
+        assert Config(rules_file=rules_file)["naturals"] == "disabled"
+        with pytest.raises(TypeError):
+            config["dot"] = "disabled"
+        with pytest.raises(TypeError):
+            config.update(dot="disabled")
+        with pytest.raises(ValueError):
+            Config(unknown="enabled")
+        with pytest.raises(ValueError):
+            config.replace(naturals="enabled")
+
+        transformer = Transformer({"frac": "disabled"})
+        assert isinstance(transformer.config, Config)
+        assert transformer.get_transformed_str(r"$\frac a b$") == r"$\frac a b$"
+
+
+    def test_threads(self):
+        docs = []
+        for filename in sorted(glob.glob("tests/arxiv_*.tex")):
+            with io.open(filename, 'r', encoding='utf-8') as file_in:
+                docs.append(file_in.read())
+        transformers = [Transformer(), Transformer(Config(dot="enabled", sub_superscript="aggressive"))]
+        expected = [transformer.get_transformed_str(doc) for transformer in transformers for doc in docs]
+
+        shared_jobs = [(transformer, doc) for transformer in transformers for doc in docs] * 4
+        pool = ThreadPool(8)
+        try:
+            results = pool.map(lambda job: job[0].get_transformed_str(job[1]), shared_jobs)
+        finally:
+            pool.close()
+            pool.join()
+        assert results == expected * 4
+
+
+    def test_batch(self, rules_file):
+        # matches at the start and end of environments, across groups and reaching over the "\n"
+        maths = [(math, "inline") for math in
+                 [r"|a>", r"a_bc", r"x", r"<a", r"b|c>", r"\vec{x}. a*b", r"\sum_{i<m \\ j<n}", r"", r"a_{b_cd}",
+                  r"q.. \frac a+b 2", r"\alpha^*", r"x -> y", r"{|a>} ... <b|", r"a ->^{+1} b", r"y"]]
+        maths.append(("a = b\nc = d\n", "align"))
+        for config in [Config(dot="enabled", brackets="enabled"), Config(sub_superscript="aggressive"),
+                       Config(rules_file=rules_file)]:
+            for i in range(len(maths)):
+                batch = maths[i:] + maths[:i]
+                expected = transform_math_batch((config.replace(batch="disabled"), batch, False, True))
+                assert transform_math_batch((config, batch, False, True)) == expected
+                assert transform_math_batch((config, batch[::-1], False, True)) == expected[::-1]
+        assert transform_math_batch((Config(), maths, False, False))[0][:2] == (r"\ket{a}", [{"type": "braket", "start": 0, "end": 7}])
+
+
+    def test_changed_lines(self):
+        diff_str = get_inside_str(r'''
+            diff --git a/x.tex b/x.tex
+            --- a/x.tex
+            +++ b/x.tex
+            @@ -2 +2 @@ a
+            -b
+            +B
+            @@ -5 +4,0 @@ d
+            -e
+            @@ -6,0 +6 @@ f
+            +new
+            diff --git a/old.tex b/old.tex
+            --- a/old.tex
+            +++ /dev/null
+            @@ -1 +0,0 @@
+            -gone
+            ''')
+        assert get_changed_lines(diff_str) == {"x.tex": [(2, 2), (4, 6)]}
+        assert get_changed_lines(diff_str.replace("@@ -5 +4,0 @@ d", "@@ -4,2 +4 @@ d\n d")) == \
+            {"x.tex": [(2, 2), (4, 6)]}
+
+        # a removed "-- a remark" and an added "++ x" line look like file headers
+        assert get_changed_lines(get_inside_str(r'''
+            --- a/x.tex
+            +++ b/x.tex
+            @@ -3,2 +3,3 @@
+            --- a remark
+            +++ x
+            +$a*b$
+             c
+            @@ -9 +10 @@
+            -d
+            +$x$
+            ''')) == {"x.tex": [(3, 4), (10, 10)]}
+
+        # git quotes non-ASCII filenames with the octal escapes of their UTF-8 bytes
+        quoted_diff = '--- "a/kapitel_\\303\\274.tex"\n+++ "b/kapitel_\\303\\274.tex"\n@@ -1 +1 @@\n-a\n+b\n'
+        assert get_changed_lines(quoted_diff) == {"kapitel_ü.tex": [(1, 1)]}
+        with pytest.raises(ValueError):
+            get_changed_lines(quoted_diff.replace("\\274", "\\q"))
+
+
+    def test_changed_math_edits(self, trans):
+        with io.open("tests/test_file.tex", 'r', encoding='utf-8') as file_in:
+            content = file_in.read()
+        doc_tree = trans.get_transformed_tree(content)
+        edits = trans.get_changed_math_edits(content, [(1, len(content))])
+        assert [edit["content"] for edit in edits] == \
+            [el["content"] for el in doc_tree if el["type"] == "math_env" and el["pretexes"]]
+
+        # $u_tt$ is on line 16, the first align from line 19 to 23
+        edits = trans.get_changed_math_edits(content, [(16, 16), (20, 20)])
+        assert [(edit["line"], content[edit["start"]:edit["end"]].count("\n")) for edit in edits] == [(16, 0), (19, 4)]
+        assert edits[0]["content"] == "u_{tt}"
+        assert trans.get_changed_math_edits(content, [(17, 18)]) == []
+
+
+    def test_first_change(self, trans):
+        with io.open("tests/test_file.tex", 'r', encoding='utf-8') as file_in:
+            content = file_in.read()
+        assert trans.get_first_change(content) == {"start": 288, "line": 16, "column": 3, "type": "sub_superscript"}
+        transformer = Transformer(trans.config.replace(sub_superscript="disabled"))
+        assert transformer.get_first_change(content)["type"] == "auto_align"
+        test_str = "% $a*b$\n$x$ and $|\\psi>$ and\n  $y -> z$"
+        assert trans.get_first_change(test_str) == {"start": 17, "line": 2, "column": 10, "type": "braket"}
+        assert Transformer(trans.config.replace(braket="disabled")).get_first_change(test_str) == \
+            {"start": 33, "line": 3, "column": 5, "type": "arrow"}
+        assert trans.get_first_change(r"$x$ and $\frac{a}{b}$") is None
+
+
+    def test_treeformat(self, trans):
+        with io.open("tests/test_file.tex", 'r', encoding='utf-8') as file_in:
+            doc_tree = trans.get_transformed_tree(file_in.read())
+        doc_tree[1]["pretexes"].append({"type": "ünïcode", "start": 300, "end": 2})
+        doc_tree.append({"type": "text", "content": "ä" * 100})
+        data = encode_tree(doc_tree)
+        assert decode_tree(data) == doc_tree
+        assert decode_tree(memoryview(bytearray(data))) == doc_tree
+        assert len(data) < len(pickle.dumps(doc_tree, pickle.HIGHEST_PROTOCOL))
+        assert decode_tree(encode_tree([])) == []
+        for invalid_data in [b"", b"PTX", data[:-1], data + b"\0", b"XYZ" + data[3:], data[:3] + b"\2" + data[4:]]:
+            with pytest.raises(ValueError):
+                decode_tree(invalid_data)
+
+
     def test_re_sub_superscript(self, trans):
-        trans.config["sub_superscript"] = "enabled"
+        trans.config = trans.config.replace(sub_superscript="enabled")
         test_cases = [
             (r"a_abc", r"a_{abc}"),
             (r"a_ abc b", r"a_ {abc} b"),
@@ -178,7 +349,7 @@ a\cdot b
 
 
     def test_re_sub_superscript_agg(self, trans):
-        trans.config["sub_superscript"] = "aggressive"
+        trans.config = trans.config.replace(sub_superscript="aggressive")
         test_cases = [
             (r"a_abc", r"a_{abc}"),
             (r"a_ abc b", r"a_ {abc} b"),
@@ -194,7 +365,7 @@ a\cdot b
 
 
     def test_cdot(self, trans):
-        trans.config["cdot"] = "enabled"
+        trans.config = trans.config.replace(cdot="enabled")
         test_cases = [
             (r"a*b", r"a\cdot b"),
             (r"a*b*c", r"a\cdot b\cdot c"),
@@ -205,7 +376,7 @@ a\cdot b
 
 
     def test_dots(self, trans):
-        trans.config["dots"] = "enabled"
+        trans.config = trans.config.replace(dots="enabled")
         test_cases = [
             (r"1,...,...b", r"1,\dots ,\dots b"),
             (r"a....b", r"a....b")]
@@ -215,7 +386,7 @@ a\cdot b
 
 
     def test_frac(self, trans):
-        trans.config["frac"] = "enabled"
+        trans.config = trans.config.replace(frac="enabled")
         test_cases = [
             (r"\frac a+b c+d", r"\frac{a+b}{c+d}"),
             (r"\frac a+b 2", r"\frac{a+b}{2}"),
@@ -227,14 +398,14 @@ a\cdot b
 
 
     def test_dot_normal(self, trans):
-        trans.config["dot"] = "enabled"
+        trans.config = trans.config.replace(dot="enabled")
         test_cases = [(r"a b. c", r"a \dot{b} c")]
         for test_input, expected_output in test_cases:
             assert get_transformed_math(test_input, trans.config)[0] == expected_output
 
 
     def test_re_ddot_easy(self, trans):
-        trans.config["dot"] = "enabled"
+        trans.config = trans.config.replace(dot="enabled")
         testcases = [
             (r"$a \phi.. b$", r"$a \ddot{\phi} b$"),
             (r"b.f", r"b.f"),
@@ -249,7 +420,7 @@ a\cdot b
 
 
     def test_re_ddot_compl(self, trans):
-        trans.config["dot"] = "enabled"
+        trans.config = trans.config.replace(dot="enabled")
         invalid_testcases = [r"$\phi..b$", r"$a\vec x..b$", r"$a\vec{abc}..b$"]
         for test_input in invalid_testcases:
             assert get_transformed_math(test_input, trans.config)[0] == test_input
@@ -267,7 +438,7 @@ a\cdot b
 
 
     def test_braket(self, trans):
-        trans.config["braket"] = "enabled"
+        trans.config = trans.config.replace(braket="enabled")
         testcases = [
             (r"foo  bar <a|b|c>", r"foo  bar \braket{a|b|c}"),
             (r"foo  bar <a|b>", r"foo  bar \braket{a|b}"),
@@ -293,7 +464,7 @@ a\cdot b
             result = get_transformed_math(test_input, trans.config)
             assert result[0] == test_output
 
-        trans.config["arrow"] = "conservative"
+        trans.config = trans.config.replace(arrow="conservative")
         testcases = [
             (r"a -> b", r"a \to b"),
             (r"a ->^{1+1} b", ""),
@@ -328,7 +499,7 @@ a\cdot b
         ]
 
         for name, test_input, test_output in test_cases:
-            trans.config[name] = "enabled"
+            trans.config = trans.config.replace({name: "enabled"})
             result = get_transformed_math(test_input, trans.config)
             assert result[0] == test_output
 
@@ -377,6 +548,143 @@ a\cdot b
         assert get_transformed_math(test_string_1, test_config, "align")[0] == test_string_1
 
 
+    def test_nested_groups(self):
+        config = get_default_config()
+        config["dot"] = "enabled"
+        testcases = [
+            (r"a \vec{a_{1}}. b", r"a \dot{\vec{a_{1}}} b"),
+            (r"\sum_{i<m_{1} \\ j<n}", r"\sum_{\substack{i<m_{1} \\ j<n}} "),
+            (r"a ->^{x^{2}} b", r"a \xrightarrow{x^{2}} b"),
+            (r"\frac a{b c} d", r"\frac{a{b c}}{d}"),
+            (r"x^{a*b} \frac{a*b}{c}", r"x^{a\cdot b} \frac{a\cdot b}{c}"),
+            (r"\{a*b\} {}*{", r"\{a\cdot b\} {}*{"),
+            (r"{<a|b}|c>", r"{<a|b}|c>")
+        ]
+        for test_input, test_output in testcases:
+            assert get_transformed_math(test_input, config)[0] == test_output
+
+        result, trafos = get_transformed_math(r"x^{a*b} + y_{i<=j}", config)
+        assert [result[trafo["start"]:trafo["end"]] for trafo in trafos] == [r"\cdot ", r"\leq "]
+
+
+    def test_parse_math(self):
+        nodes = parse_math(r"x^{a_{i}} + \{b\} + {}")
+        assert len(nodes) == 3
+        assert nodes[0]["text"] == "x^{" + get_placeholder(0) + r"} + \{b\} + {}"
+        assert nodes[1]["text"] == "{a_{" + get_placeholder(0) + "}}"
+        assert nodes[2]["text"] == "{i}"
+        assert join_math(nodes, [(node["text"], []) for node in nodes]) == (r"x^{a_{i}} + \{b\} + {}", [])
+
+        results = [(node["text"], []) for node in nodes]
+        results[1] = ("a", [])
+        assert join_math(nodes, results) is None
+
+        nested = "{a " * 5000 + "a*b" + "}" * 5000
+        result, trafos = get_transformed_math(nested, Config(get_default_config()))
+        assert result == nested.replace("*", r"\cdot ")
+        assert [result[trafo["start"]:trafo["end"]] for trafo in trafos] == [r"\cdot "]
+
+        # " -> " overlaps its replacement " \to ", so its pass searches again after each one
+        arrows = "a -> " * 20000 + "b"
+        result, trafos = get_transformed_math(arrows, Config(get_default_config()))
+        assert result == "a \\to " * 20000 + "b"
+        assert len(trafos) == 20000 and trafos[-1]["start"] == len(result) - len(" \\to b")
+
+
+    def test_source_map(self):
+        test_str = get_inside_str(r"""
+            x % comment
+            $a -> b$ $\frac a+b c$ \text{a*b} $y^{a*b}$
+            \begin{align}
+            a = b
+            c = d
+            \end{align}
+            """)
+        transformer = Transformer()
+        output = transformer.get_transformed_str(test_str)
+        source_map = transformer.get_source_map(test_str)
+        line_in = test_str.split("\n")[1]
+        line_out = output.split("\n")[1]
+        for part in ["$a", "b$", r"\text", "b}$"]:
+            assert source_map.get_input_position(2, line_out.index(part) + 1) == (2, line_in.index(part) + 1)
+        assert source_map.get_input_position(4, 6) == (4, 5)
+        for out_offset in range(len(output)):
+            in_offset = source_map.get_input_offset(out_offset)
+            if output[out_offset] in "x$\n":
+                assert test_str[in_offset] == output[out_offset]
+
+
+    def test_source_map_lines(self, tmpdir):
+        filename = str(tmpdir.join("rules.json"))
+        with io.open(filename, 'w', encoding='utf-8') as file_out:
+            file_out.write(json.dumps({"rules": [{"name": "newline", "pattern": "//", "replacement": "\\\\\n"}]},
+                                      ensure_ascii=False))
+        transformer = Transformer()
+        transformer.config = get_default_config(filename)
+        source_map = transformer.get_source_map("$a // b // c$\n\nfoo $x$\n")
+        assert [source_map.get_input_line(line) for line in range(1, 7)] == [1, 1, 1, 2, 3, 4]
+
+        log_str = get_inside_str(r"""
+            ! Undefined control sequence.
+            l.5 foo $\x
+                        $
+            LaTeX Warning: Reference `a' on page 1 undefined on input line 4.
+            Overfull \hbox (1.0pt too wide) in paragraph at lines 4--5
+            ./test_t.tex:5: Undefined control sequence.
+            """)
+        assert translate_log(log_str, source_map, "test_t.tex", "test.tex") == get_inside_str(r"""
+            ! Undefined control sequence.
+            l.3 foo $\x
+                        $
+            LaTeX Warning: Reference `a' on page 1 undefined on input line 2.
+            Overfull \hbox (1.0pt too wide) in paragraph at lines 2--3
+            ./test.tex:3: Undefined control sequence.
+            """)
+
+
+    def test_stats(self):
+        transformer = Transformer()
+        stats = get_empty_stats(transformer.config)
+        test_str = r"$a*b$ and $x$ and \begin{align}a*b*c -> d\end{align} and $\frac a+b c*d$"
+        transformer.get_transformed_tree(test_str, stats=stats)
+        assert stats["files"] == 1
+        assert stats["chars_in"] == len(test_str)
+        assert stats["environments"] == {"inline": {"count": 3, "unchanged": 1}, "align": {"count": 1, "unchanged": 0}}
+        assert stats["rules"]["cdot"] == {"matches": 4, "chars_changed": 4 * len(r"\cdot "), "skipped": 1}
+        assert stats["rules"]["arrow"]["matches"] == 1
+        assert stats["rules"]["arrow"]["chars_changed"] == len(r" \to ")
+        assert stats["rules"]["frac"] == {"matches": 1, "chars_changed": len(r"\frac{a+b}{c*d}"), "skipped": 3}
+        assert stats["rules"]["braket"]["matches"] == 0
+        assert "dot" not in stats["rules"]
+        assert set(stats["seconds"]) == {"document", "strip_comments", "hide", "segment", "math", "tree"}
+
+        result = json.loads(format_stats({"a.tex": stats, "b.tex": stats}))
+        assert result["files"]["a.tex"]["rules"]["cdot"]["matches"] == 4
+        assert result["total"]["rules"]["cdot"]["matches"] == 8
+        assert result["total"]["environments"]["inline"] == {"count": 6, "unchanged": 2}
+        assert result["total"]["files"] == 2
+
+        csv_lines = format_stats({"a.tex": stats}, "csv").splitlines()
+        assert csv_lines[0] == "file,category,name,value"
+        assert "a.tex,rule_matches,cdot,4" in csv_lines
+        assert "total,environment_unchanged,inline,1" in csv_lines
+        with pytest.raises(ValueError):
+            format_stats({}, "xml")
+
+
+    @pytest.mark.skipif(sys.version_info < (3, 9), reason="tracemalloc.reset_peak needs python 3.9")
+    def test_memory(self):
+        # peak bytes per input byte of each stage, about 1.5 times what they were when this was added
+        budget = {"document": 3, "strip_comments": 5, "hide": 4, "segment": 4, "math": 18, "tree": 6,
+                  "restore": 1, "join": 3, "total": 15}
+        with io.open("tests/arxiv_math.tex", encoding="utf-8") as f:
+            memory = get_memory_stats(Transformer(), f.read())
+        assert set(memory) == set(budget)
+        for stage, peak in budget.items():
+            assert memory[stage]["peak"] <= peak, "{} takes {:.2f} bytes per input byte".format(stage, memory[stage]["peak"])
+        assert memory["total"]["allocated"] < 3  # just the output is kept
+
+
     def test_skip(self, trans):
         invariant_inputs = [
             (r"$a.$", ["dot"]),
@@ -391,10 +699,88 @@ a\cdot b
         ]
         for test_input, exclude_cmds in invariant_inputs:
             for cmd in exclude_cmds:
-                trans.config[cmd] = "disabled"
+                trans.config = trans.config.replace({cmd: "disabled"})
             assert get_transformed_math(test_input, trans.config)[0] == test_input
 
 
+    @pytest.fixture()
+    def rules_file(self, tmpdir):
+        rules = {"rules": [
+            {"name": "leftrightarrow", "pattern": "<->", "replacement": "\\leftrightarrow "},
+            {"name": "reals", "pattern": "\\bR\\^", "replacement": "\\\\mathbb{R}^", "regex": True,
+             "before": "sub_superscript"},
+            {"name": "naturals", "pattern": "NN", "replacement": "\\mathbb{N}", "default": "disabled"}
+        ]}
+        filename = str(tmpdir.join("rules.json"))
+        with io.open(filename, 'w', encoding='utf-8') as file_out:
+            file_out.write(json.dumps(rules, ensure_ascii=False))
+        return filename
+
+
+    def test_user_rules(self, rules_file):
+        config = get_default_config(rules_file)
+        assert config["leftrightarrow"] == "enabled"
+        assert config["naturals"] == "disabled"
+        assert get_transformed_math(r"a <-> b, R^nm x, NN", config)[0] == r"a \leftrightarrow  b, \mathbb{R}^{nm} x, NN"
+
+        config["leftrightarrow"] = "disabled"
+        config["naturals"] = "enabled"
+        assert get_transformed_math(r"a <-> b, NN", config)[0] == r"a <-> b, \mathbb{N}"
+
+        config_expected = get_default_config(rules_file)
+        config_expected["naturals"] = "enabled"
+        assert pretex.parse_cmd_arguments(get_default_config(), ["in.tex", "--rules", rules_file, "--set",
+                                                                 "naturals=enabled"]) == (
+            "in.tex", "in_t.tex", config_expected)
+
+
+    def test_triggers(self, tmpdir):
+        config = get_default_config()
+        rule_passes, _, trigger_index = get_prepared_rules(config)
+        skips = {}
+        assert len(get_skipped_passes(r"\alpha_i", rule_passes, trigger_index, skips)) == len(rule_passes) - 2
+        assert skips["cdot"] == 1
+        assert "sub_superscript" not in skips and "substack" not in skips
+        assert get_transformed_math(r"x", config) == (r"x", [])
+
+        # the replacement of the first rule creates the trigger of the second one
+        filename = str(tmpdir.join("rules.json"))
+        with io.open(filename, 'w', encoding='utf-8') as file_out:
+            file_out.write(json.dumps({"rules": [
+                {"name": "reals_short", "pattern": "RR", "replacement": "R^"},
+                {"name": "reals", "pattern": "\\bR\\^", "replacement": "\\\\mathbb{R}^", "regex": True, "triggers": ["R^"]}
+            ]}, ensure_ascii=False))
+        assert get_transformed_math(r"RRn x", get_default_config(filename))[0] == r"\mathbb{R}^n x"
+
+
+    def test_user_rules_invalid(self, tmpdir):
+        invalid_rules = [
+            {"name": "cdot", "pattern": "**", "replacement": "x"},
+            {"name": "html", "pattern": "**", "replacement": "x"},
+            {"name": "foo", "pattern": "**", "replacement": "x", "before": "unknown"},
+            {"name": "foo", "pattern": "(", "replacement": "x", "regex": True},
+            {"name": "foo", "replacement": "x"},
+            {"name": "foo", "pattern": "a", "replacement": "x", "regex": True, "triggers": []}
+        ]
+        for i, rule in enumerate(invalid_rules):
+            filename = str(tmpdir.join("rules{}.json".format(i)))
+            with io.open(filename, 'w', encoding='utf-8') as file_out:
+                file_out.write(json.dumps({"rules": [rule]}, ensure_ascii=False))
+            with pytest.raises(ValueError):
+                get_default_config(filename)
+
+
+    def test_prepare_rules(self):
+        literal_rules = [rule for rule in get_builtin_rules(get_default_config()) if not hasattr(rule[1], "search")]
+        assert len(literal_rules) == 7
+        assert len(prepare_rules(literal_rules)) == 3
+
+        house_rules = [("house", "\\hs{}@".format(i), "\\mathrm{{h{}}}".format(i)) for i in range(12)]
+        assert len(prepare_rules(literal_rules + house_rules)) == 3
+        assert len(prepare_rules([("a", "ab", "x"), ("b", "bc", "y")])) == 2
+        assert len(prepare_rules([("a", "ab", "xc"), ("b", "cd", "y")])) == 2
+
+
     @pytest.fixture(scope="module")
     def mock_testfile(self, request):
         with io.open("test_simple.tex", 'w', encoding='utf-8') as file_out:
@@ -415,6 +801,114 @@ a\cdot b
         assert test_file_content == r"$\frac{aa}{bb}$"
 
 
+    def test_main_unchanged_output(self, monkeypatch, mock_testfile):
+        monkeypatch.setattr(sys, 'argv', "xxx test_simple.tex".split())
+        pretex.main()
+        os.utime("test_simple_t.tex", (1000000000, 1000000000))
+        pretex.main()
+        assert os.path.getmtime("test_simple_t.tex") == 1000000000
+
+        with io.open("test_simple_t.tex", 'w', encoding='utf-8') as file_out:
+            file_out.write(r"$outdated$")
+        os.utime("test_simple_t.tex", (1000000000, 1000000000))
+        pretex.main()
+        assert os.path.getmtime("test_simple_t.tex") != 1000000000
+        with io.open("test_simple_t.tex", 'r', encoding='utf-8') as file_read:
+            assert file_read.read() == r"$\frac{aa}{bb}$"
+        assert not [f for f in os.listdir(".") if f.startswith(".pretex_")]
+
+
+    @pytest.mark.skipif(not hasattr(os, "symlink") or os.name == "nt", reason="needs symlinks")
+    def test_write_if_changed_symlink(self, tmpdir):
+        target = str(tmpdir.join("target.tex"))
+        link = str(tmpdir.join("link_t.tex"))
+        with io.open(target, 'w', encoding='utf-8') as file_out:
+            file_out.write("old")
+        os.symlink(target, link)
+        assert pretex.write_if_changed(link, ["n", "ew ", "ä"])
+        assert os.path.islink(link)
+        with io.open(target, 'r', encoding='utf-8') as file_read:
+            assert file_read.read() == "new ä"
+        assert not pretex.write_if_changed(link, ["new ä"])
+        assert sorted(os.listdir(str(tmpdir))) == ["link_t.tex", "target.tex"]
+
+
+    def test_main_map(self, monkeypatch, mock_testfile, tmpdir, capsys):
+        log_filename = str(tmpdir.join("test_simple_t.log"))
+        with io.open(log_filename, 'w', encoding='utf-8') as file_out:
+            file_out.write("./test_simple_t.tex:1: Undefined control sequence.\n")
+        silent_remove("test_simple_t.tex")
+        monkeypatch.setattr(sys, 'argv', ["xxx", "map", "test_simple.tex", log_filename])
+        pretex.main()
+        assert capsys.readouterr()[0] == "./test_simple.tex:1: Undefined control sequence.\n"
+        assert not os.path.exists("test_simple_t.tex")
+
+
+    def test_main_stats(self, monkeypatch, mock_testfile, tmpdir, capsys):
+        stats_filename = str(tmpdir.join("stats.csv"))
+        monkeypatch.setattr(sys, 'argv', ["xxx", "test_simple.tex", "--stats", stats_filename])
+        pretex.main()
+        with io.open(stats_filename, 'r', encoding='utf-8') as file_read:
+            assert "test_simple.tex,rule_matches,frac,1" in file_read.read().splitlines()
+
+        monkeypatch.setattr(sys, 'argv', ["xxx", "stats", "test_simple.tex", "--set", "frac=disabled"])
+        pretex.main()
+        result = json.loads(capsys.readouterr()[0])
+        assert result["total"]["files"] == 1
+        assert result["total"]["environments"]["inline"] == {"count": 1, "unchanged": 1}
+
+        # the format is checked before the files are read
+        monkeypatch.setattr(sys, 'argv', ["xxx", "stats", "missing.tex", "--format", "xml"])
+        with pytest.raises(ValueError):
+            pretex.main()
+
+
+    def test_main_diff(self, monkeypatch, mock_testfile, tmpdir, capsys):
+        diff_filename = str(tmpdir.join("changes.diff"))
+        with io.open(diff_filename, 'w', encoding='utf-8') as file_out:
+            file_out.write("--- a/test_simple.tex\n+++ b/test_simple.tex\n@@ -1 +1 @@\n-$x$\n+$\\frac aa bb$\n")
+        monkeypatch.setattr(sys, 'argv', ["xxx", "diff", diff_filename])
+        pretex.main()
+        result = json.loads(capsys.readouterr()[0])
+        assert [(edit["start"], edit["end"], edit["content"]) for edit in result["test_simple.tex"]] == \
+            [(1, 12, r"\frac{aa}{bb}")]
+
+        monkeypatch.setattr(sys, 'argv', ["xxx", "diff", diff_filename, "--set", "frac=disabled"])
+        pretex.main()
+        assert json.loads(capsys.readouterr()[0]) == {}
+
+
+    def test_main_check(self, monkeypatch, mock_testfile, capsys):
+        silent_remove("test_simple_t.tex")
+        monkeypatch.setattr(sys, 'argv', ["xxx", "--check", "test_simple.tex", "tests/test_tags.tex"])
+        assert pretex.main() == 1
+        assert capsys.readouterr()[0] == "test_simple.tex:1:2: frac\n"
+        assert not os.path.exists("test_simple_t.tex")
+
+        monkeypatch.setattr(sys, 'argv', ["xxx", "--check", "test_simple.tex", "--set", "frac=disabled"])
+        assert pretex.main() == 0
+        assert capsys.readouterr()[0] == ""
+
+
+    def test_main_diff_subdirectory(self, monkeypatch, tmpdir, capsys):
+        try:
+            subprocess.check_output(["git", "init", "-q", str(tmpdir)])
+        except (OSError, subprocess.CalledProcessError):
+            pytest.skip("needs git")
+        tmpdir.mkdir("chapters").join("intro.tex").write("$a_ij$\n")
+        diff_str = "--- a/chapters/intro.tex\n+++ b/chapters/intro.tex\n@@ -0,0 +1 @@\n+$a_ij$\n"
+        tmpdir.join("changes.diff").write(diff_str)
+        monkeypatch.chdir(str(tmpdir.join("chapters")))
+        monkeypatch.setattr(sys, 'argv', ["xxx", "diff", "../changes.diff"])
+        pretex.main()
+        assert [edit["content"] for edit in json.loads(capsys.readouterr()[0])["chapters/intro.tex"]] == ["a_{ij}"]
+
+        # a file of the diff that isn't there is an error, not a clean result
+        tmpdir.join("changes.diff").write(diff_str.replace("intro", "missing"))
+        with pytest.raises(ValueError):
+            pretex.main()
+
+
     def test_main_complex(self, monkeypatch):
         monkeypatch.setattr(sys, 'argv', "xxx tests/test_file.tex --html --set auto_align=enabled --set brackets=enabled".split())
         pretex.main()